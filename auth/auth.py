@@ -1,6 +1,12 @@
+from collections import OrderedDict
+import copy
 from datetime import datetime, timedelta
+import hashlib
+import logging
 import os
-from flask import request
+import threading
+import time
+from flask import g, request
 from functools import wraps
 import jwt
 from urllib.request import urlopen
@@ -8,6 +14,11 @@ from urllib.request import urlopen
 
 JWT_SECRET = os.environ.get('JWT_SECRET', 'abc123abc1234')
 ALGORITHMS = ["HS256"]
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# how long a token without an exp claim stays cached
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+logger = logging.getLogger(__name__)
 
 # AuthError Exception
 '''
@@ -78,14 +89,17 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = frozenset(payload['permissions'])
+    # None only needs a valid token, the handler checks the permissions
+    if permission is not None and permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -108,6 +122,67 @@ def check_permissions(permission, payload):
 '''
 
 
+'''
+TokenCache
+    a bounded LRU of the tokens already verified, keyed by their sha256, so the
+    tokens polled by the dashboards are decoded and HMAC checked once. Entries
+    are dropped when the token expires.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, payload):
+        expires = payload.get('exp') if isinstance(payload, dict) else None
+        if not isinstance(expires, (int, float)):
+            expires = time.time() + TOKEN_CACHE_TTL
+        permissions = payload.get('permissions') if isinstance(
+            payload, dict) else None
+        entry = (payload, frozenset(permissions or ()), expires)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
+def verify_token(token):
+    """Returns (payload, permissions frozenset, exp) from the cache or by verifying the token
+
+    The payload is a copy, the handlers get it as current_user and must not
+    change the cached one.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    entry = token_cache.get(key)
+    if entry is None:
+        entry = token_cache.put(key, verify_decode_jwt(token))
+    payload, permissions, expires = entry
+    return copy.deepcopy(payload), permissions, expires
+
+
 def verify_decode_jwt(token):
     try:
         # decoding the payload to fetch the stored details
@@ -141,9 +216,14 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            started = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                payload, permissions, expires = verify_token(token)
+                check_permissions(permission, payload, permissions)
+            finally:
+                g.auth_time = (time.perf_counter() - started) * 1000
+                logger.debug('auth %s took %.2fms', permission, g.auth_time)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -1,6 +1,7 @@
 from multiprocessing.dummy import Array
 import os
 from turtle import st
+import click
 from flask import Flask, request, abort, jsonify
 from flask_cors import CORS
 from flask_migrate import Migrate
@@ -8,14 +9,30 @@ from flask_restful import Api, Resource
 import jwt
 from dotenv import find_dotenv, load_dotenv
 from auth.auth import AuthError, requires_auth
-from flaskr.save_image import save_pic
-from models.models import Arrondissement, Departement, Fonction, Media, Membre, Role, Structure, StructureMembre, TypeStructure, TypeStructure_fonction, setup_db, db, User, Region
+from flaskr.media_store import MEDIA_SENDFILE, media_base_url, send_media
+from flaskr.save_image import MAX_CONTENT_LENGTH, ImageError, process_pic, remove_pic, save_pic
+from models.models import Arrondissement, Departement, Fonction, Media, Membre, RefreshToken, Role, Structure, StructureMembre, TypeStructure, TypeStructure_fonction, setup_db, db, User, Region
+from models.db_config import pool_metrics
+from models.index_check import unindexed_foreign_keys, unindexed_foreign_keys_in_database
+from models.routing import replica_monitor
+from models.reference_cache import reference_cache
+from .bulk_import import import_membres, import_structures, read_rows
+from .compression import compression_metrics, init_compression
+from .export import FORMATS, export_response, membres_query, structures_query
+from .fieldsets import Fieldset
+from .http_cache import conditional
+from .instrumentation import init_instrumentation, request_metrics
+from .json_provider import FastJSONProvider
+from .pagination import paginate
+from .representation import written
+from .search import TYPES, by_name, search, search_limit
+from .transaction import transactional
 from .validate import validate_dateformat, validate_email_and_password, validate_membre, validate_user
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 from operator import or_
+from sqlalchemy.orm import selectinload
 
-ITEMS_PER_PAGE = 10
 ENV_FILE = find_dotenv()
 if ENV_FILE:
     load_dotenv(ENV_FILE)
@@ -23,24 +40,32 @@ if ENV_FILE:
 JWT_SECRET = os.environ.get('JWT_SECRET', 'abc123abc1234')
 
 
-def handle_pagination(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
-    return selection[start:end]
+def issue_tokens(claims):
+    """Signs an access token and creates a refresh token for the user of the claims"""
+    return {
+        "exp": claims["exp"],
+        "token": jwt.encode(claims, JWT_SECRET, algorithm="HS256"),
+        "refresh_token": RefreshToken.issue(claims["userid"])
+    }
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json = FastJSONProvider(app)
     app.config['SECRET_KEY'] = JWT_SECRET
+    app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+    app.use_x_sendfile = MEDIA_SENDFILE == 'x-sendfile'
+    app.config['MEDIA_BASE_URL'] = media_base_url(app)
     setup_db(app)
+    init_instrumentation(app, db)
     migrate = Migrate(app, db)
     api = Api(app)
     '''
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     '''
     CORS(app)
+    init_compression(app)
 
     '''
   @TODO: Use the after_request decorator to set Access-Control-Allow
@@ -54,6 +79,35 @@ def create_app(test_config=None):
         response.headers.add("Access-Control-Allow-Credentials", "true")
         return response
 
+    """
+    connection pool usage and replica lags of this worker, to size DB_POOL_SIZE,
+    and the sizes of its responses by endpoint, before and after compression,
+    their timings and statement counts, and the slowest statements
+    """
+    @app.route("/api/v1/metrics", methods=["GET"])
+    @requires_auth('get:metrics')
+    def get_metrics(current_user):
+        return jsonify({'success': True, 'data': {'pools': pool_metrics(), 'replica_lags': replica_monitor.json(),
+                                                  'responses': compression_metrics(), 'requests': request_metrics()}}), 200
+
+    """
+    autocomplete across the names, ?q=text&types=structures,membres&limit=10,
+    only the types the token can read (get:<type>) are searched
+    """
+    @app.route("/api/v1/search", methods=["GET"])
+    @requires_auth(None)
+    def search_names(current_user):
+        name = request.args.get('q', '').strip()
+        if not name:
+            abort(400)
+        types = request.args.get('types')
+        types = types.split(',') if types else list(TYPES)
+        if any(type_name not in TYPES for type_name in types):
+            abort(400)
+        permissions = current_user.get('permissions') or ()
+        types = [type_name for type_name in types if 'get:' + type_name in permissions]
+        return jsonify({'success': True, 'data': search(name, types, search_limit(request))}), 200
+
     """
     get current user information from the token
     """
@@ -70,6 +124,7 @@ def create_app(test_config=None):
     register a new user to the database
     """
     @app.route('/api/v1/register', methods=['POST'])
+    @transactional
     def register():
         data = request.get_json()
         email = data.get('email', None)
@@ -117,14 +172,10 @@ def create_app(test_config=None):
                 data.get('password')
             )
             if user:
-                # token should expire after 30 minutes
-                response = {}
-                response["exp"] = datetime.utcnow() + timedelta(minutes=30)
-                response["token"] = jwt.encode(
-                    user,
-                    JWT_SECRET,
-                    algorithm="HS256"
-                )
+                # token should expire after 30 minutes, the refresh token
+                # renews it without checking the password again
+                response = issue_tokens(user)
+                db.session.commit()
 
                 return jsonify({
                     "success": True,
@@ -139,29 +190,74 @@ def create_app(test_config=None):
         except:
             abort(500)
 
+    '''
+    Exchange a refresh token for a new access token, the refresh token is rotated
+    '''
+    @app.route("/api/v1/token/refresh", methods=["POST"])
+    def refresh_token():
+        data = request.get_json(silent=True) or {}
+        if not data.get('refresh_token'):
+            abort(400)
+        token = RefreshToken.getByToken(data['refresh_token'])
+        if token is None:
+            return jsonify({'success': False, 'error': 401, 'message': 'Invalid refresh token'}), 401
+        if not token.revoked and not token.isValid():
+            return jsonify({'success': False, 'error': 401, 'message': 'Refresh token expired'}), 401
+        # revoked, or by a concurrent refresh or logout since it was read
+        if token.revoked or not token.claim():
+            if token.wasRotated():
+                # a rotated token is used again: it leaked, log the user out everywhere
+                RefreshToken.revokeAll(token.user_id)
+                db.session.commit()
+            return jsonify({'success': False, 'error': 401, 'message': 'Invalid refresh token'}), 401
+        try:
+            response = issue_tokens(token.user.claims())
+            db.session.commit()
+            return jsonify({
+                "success": True,
+                "message": "Successfully refreshed",
+                "data": response
+            })
+        except:
+            abort(500)
+
+    @app.route("/api/v1/logout", methods=["POST"])
+    def logout():
+        data = request.get_json(silent=True) or {}
+        if not data.get('refresh_token'):
+            abort(400)
+        token = RefreshToken.getByToken(data['refresh_token'])
+        if token is not None:
+            token.revoke('LOGOUT')
+            db.session.commit()
+        return jsonify({'success': True, 'message': 'Successfully logged out'}), 200
+
     '''
     api to manage regions
     '''
     @app.route('/api/v1/regions/<int:region_id>')
     @requires_auth('get:regions')
+    @conditional('regions', reference_cache)
     def get_region_by_id(current_user, region_id):
-        region = Region.query.filter_by(id=region_id).one_or_none()
+        region = reference_cache.get('regions', region_id)
         if region is None:
             abort(404)
-        return jsonify({'success': True, 'data': region.json()}), 200
+        return jsonify({'success': True, 'data': Fieldset(request, Region).project(region)}), 200
 
     @app.route('/api/v1/regions/<string:name>')
     @requires_auth('get:regions')
+    @conditional('regions')
     def get_region_by_name(current_user, name):
-        regions = Region.query.filter(
-            Region.region_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, Region)
+        regions = by_name(Region, Region.region_name, name, search_limit(request), view.options())
         data = []
         for region in regions:
-            data.append(region.json())
+            data.append(view(region))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/regions', methods=["POST"])
     @requires_auth('post:regions')
+    @transactional
     def post_regions(current_user):
         data = request.get_json()
         if not data.get('name'):
@@ -172,12 +268,14 @@ def create_app(test_config=None):
         try:
             region = Region(region_name=data["name"])
             region.insert()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': region.json()}), 201
         except:
             abort(500)
 
     @app.route('/api/v1/regions/<int:region_id>', methods=["PUT"])
     @requires_auth('put:regions')
+    @transactional
     def put_regions(current_user, region_id):
         data = request.get_json()
         if not data.get('name'):
@@ -192,38 +290,46 @@ def create_app(test_config=None):
         try:
             region.region_name = data["name"]
             region.update()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': region.json()}), 200
         except:
             abort(500)
 
     @app.route('/api/v1/regions')
     @requires_auth('get:regions')
+    @conditional('regions')
     def get_all_regions(current_user):
-        regions = Region.query.all()
+        view = Fieldset(request, Region)
+        regions, meta = paginate(Region.query.options(*view.options()), request, {
+            'id': Region.id, 'name': Region.region_name})
         data = []
         for region in regions:
-            data.append(region.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(region))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/regions/<int:region_id>/departements')
     @requires_auth('get:departements')
+    @conditional('departements')
     def get_all_departements_by_region(current_user, region_id):
+        view = Fieldset(request, Departement)
         region = Region.query.filter_by(id=region_id).one_or_none()
         if region is None:
             abort(404)
         data = []
         for departement in region.departements:
-            data.append(departement.json())
+            data.append(view(departement))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/regions/<int:region_id>', methods=["DELETE"])
     @requires_auth('delete:regions')
+    @transactional
     def delete_region_by_id(current_user, region_id):
         region = Region.query.filter_by(id=region_id).one_or_none()
         if region is None:
             abort(404)
         try:
             region.delete()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': f'The region with the ID {region_id}'}), 200
         except:
             abort(500)
@@ -233,25 +339,28 @@ def create_app(test_config=None):
     '''
     @app.route('/api/v1/departements/<int:departement_id>')
     @requires_auth('get:departements')
+    @conditional('departements', reference_cache)
     def get_departement_by_id(current_user, departement_id):
-        departement = Departement.query.filter_by(
-            id=departement_id).one_or_none()
+        departement = reference_cache.get('departements', departement_id)
         if departement is None:
             abort(404)
-        return jsonify({'success': True, 'data': departement.json()}), 200
+        return jsonify({'success': True, 'data': Fieldset(request, Departement).project(departement)}), 200
 
     @app.route('/api/v1/departements/<string:name>')
     @requires_auth('get:departements')
+    @conditional('departements')
     def get_departement_by_name(current_user, name):
-        departements = Departement.query.filter(
-            Departement.departement_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, Departement)
+        departements = by_name(Departement, Departement.departement_name, name,
+                               search_limit(request), view.options(*Departement.jsonOptions()))
         data = []
         for departement in departements:
-            data.append(departement.json())
+            data.append(view(departement))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/departements', methods=["POST"])
     @requires_auth('post:departements')
+    @transactional
     def post_departements(current_user):
         data = request.get_json()
         name = data.get('name', None)
@@ -266,12 +375,14 @@ def create_app(test_config=None):
             departement = Departement(
                 departement_name=name, region_id=region)
             departement.insert()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': departement.json()}), 201
         except:
             abort(500)
 
     @app.route('/api/v1/departements/<int:departement_id>', methods=["PUT"])
     @requires_auth('put:departements')
+    @transactional
     def put_departements(current_user, departement_id):
         data = request.get_json()
         name = data.get('name', None)
@@ -290,21 +401,26 @@ def create_app(test_config=None):
             departement.departement_name = name
             departement.region_id = region
             departement.update()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': departement.json()}), 200
         except:
             abort(500)
 
     @app.route('/api/v1/departements')
     @requires_auth('get:departements')
+    @conditional('departements')
     def get_all_departements(current_user):
-        departements = Departement.query.all()
+        view = Fieldset(request, Departement)
+        departements, meta = paginate(Departement.query.options(*view.options(*Departement.jsonOptions())), request, {
+            'id': Departement.id, 'name': Departement.departement_name, 'region': Departement.region_id})
         data = []
         for departement in departements:
-            data.append(departement.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(departement))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/departements/<int:departement_id>', methods=["DELETE"])
     @requires_auth('delete:departements')
+    @transactional
     def delete_departement_by_id(current_user, departement_id):
         departement = Departement.query.filter_by(
             id=departement_id).one_or_none()
@@ -312,20 +428,24 @@ def create_app(test_config=None):
             abort(404)
         try:
             departement.delete()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'message': f'the departement with ID {departement_id} has been deleted'}), 200
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
     @app.route('/api/v1/departements/<int:departement_id>/arrondissements')
     @requires_auth('get:arrondissements')
+    @conditional('arrondissements')
     def get_all_arrondissements_by_departement(current_user, departement_id):
-        departement = Departement.query.filter_by(
+        view = Fieldset(request, Arrondissement)
+        departement = Departement.query.options(
+            *Departement.jsonOptions(), selectinload(Departement.arrondissements)).filter_by(
             id=departement_id).one_or_none()
         if departement is None:
             abort(404)
         data = []
         for arrondissement in departement.arrondissements:
-            data.append(arrondissement.json())
+            data.append(view(arrondissement))
         return jsonify({'success': True, 'data': data}), 200
 
     '''
@@ -333,25 +453,28 @@ def create_app(test_config=None):
     '''
     @app.route('/api/v1/arrondissements/<int:arrondissement_id>')
     @requires_auth('get:arrondissements')
+    @conditional('arrondissements', reference_cache)
     def get_arrondissement_by_id(current_user, arrondissement_id):
-        arrondissement = Arrondissement.query.filter_by(
-            id=arrondissement_id).one_or_none()
+        arrondissement = reference_cache.get('arrondissements', arrondissement_id)
         if arrondissement is None:
             abort(404)
-        return jsonify({'success': True, 'data': arrondissement.json()}), 200
+        return jsonify({'success': True, 'data': Fieldset(request, Arrondissement).project(arrondissement)}), 200
 
     @app.route('/api/v1/arrondissements/<string:name>')
     @requires_auth('get:arrondissements')
+    @conditional('arrondissements')
     def get_arrondissement_by_name(current_user, name):
-        arrondissements = Arrondissement.query.filter(
-            Arrondissement.arrondissement_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, Arrondissement)
+        arrondissements = by_name(Arrondissement, Arrondissement.arrondissement_name, name,
+                                  search_limit(request), view.options(*Arrondissement.jsonOptions()))
         data = []
         for arrondissement in arrondissements:
-            data.append(arrondissement.json())
+            data.append(view(arrondissement))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/arrondissements', methods=["POST"])
     @requires_auth('post:arrondissements')
+    @transactional
     def post_arrondissements(current_user):
         data = request.get_json()
         name = data.get('name', None)
@@ -366,12 +489,14 @@ def create_app(test_config=None):
             arrondissement = Arrondissement(
                 arrondissement_name=name, departement_id=departement)
             arrondissement.insert()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': arrondissement.json()}), 201
         except:
             abort(500)
 
     @app.route('/api/v1/arrondissements/<int:arrondissement_id>', methods=["PUT"])
     @requires_auth('put:arrondissements')
+    @transactional
     def put_arrondissements(current_user, arrondissement_id):
         data = request.get_json()
         name = data.get('name', None)
@@ -390,21 +515,26 @@ def create_app(test_config=None):
             arrondissement.arrondissement_name = name
             arrondissement.departement_id = departement
             arrondissement.update()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': arrondissement.json()}), 200
         except:
             abort(500)
 
     @app.route('/api/v1/arrondissements')
     @requires_auth('get:arrondissements')
+    @conditional('arrondissements')
     def get_all_arrondissements(current_user):
-        arrondissements = Arrondissement.query.all()
+        view = Fieldset(request, Arrondissement)
+        arrondissements, meta = paginate(Arrondissement.query.options(*view.options(*Arrondissement.jsonOptions())), request, {
+            'id': Arrondissement.id, 'name': Arrondissement.arrondissement_name, 'departement': Arrondissement.departement_id})
         data = []
         for arrondissement in arrondissements:
-            data.append(arrondissement.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(arrondissement))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/arrondissements/<int:arrondissement_id>', methods=["DELETE"])
     @requires_auth('delete:arrondissements')
+    @transactional
     def delete_arrondissement_by_id(current_user, arrondissement_id):
         arrondissement = Arrondissement.query.filter_by(
             id=arrondissement_id).one_or_none()
@@ -412,6 +542,7 @@ def create_app(test_config=None):
             abort(404)
         try:
             arrondissement.delete()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'message': f'the arrondissement with ID {arrondissement_id} has been deleted'}), 200
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
@@ -421,25 +552,27 @@ def create_app(test_config=None):
     '''
     @app.route('/api/v1/fonctions/<int:fonction_id>')
     @requires_auth('get:fonctions')
+    @conditional('fonctions', reference_cache)
     def get_fonction_by_id(current_user, fonction_id):
-        fonction = Fonction.query.filter_by(
-            id=fonction_id).one_or_none()
+        fonction = reference_cache.get('fonctions', fonction_id)
         if fonction is None:
             abort(404)
-        return jsonify({'success': True, 'data': fonction.json()}), 200
+        return jsonify({'success': True, 'data': Fieldset(request, Fonction).project(fonction)}), 200
 
     @app.route('/api/v1/fonctions/<string:name>')
     @requires_auth('get:fonctions')
+    @conditional('fonctions')
     def get_fonction_by_name(current_user, name):
-        fonctions = Fonction.query.filter(
-            Fonction.fonction_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, Fonction)
+        fonctions = by_name(Fonction, Fonction.fonction_name, name, search_limit(request), view.options())
         data = []
         for fonction in fonctions:
-            data.append(fonction.json())
+            data.append(view(fonction))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/fonctions', methods=["POST"])
     @requires_auth('post:fonctions')
+    @transactional
     def post_fonctions(current_user):
         data = request.get_json()
         name = data.get('name', None)
@@ -452,12 +585,14 @@ def create_app(test_config=None):
         try:
             fonction = Fonction(fonction_name=name)
             fonction.insert()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': fonction.json()}), 201
         except:
             abort(500)
 
     @app.route('/api/v1/fonctions/<int:fonction_id>', methods=["PUT"])
     @requires_auth('put:fonctions')
+    @transactional
     def put_fonctions(current_user, fonction_id):
         data = request.get_json()
         name = data.get('name', None)
@@ -474,21 +609,26 @@ def create_app(test_config=None):
         try:
             fonction.fonction_name = name
             fonction.update()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': fonction.json()}), 200
         except:
             abort(500)
 
     @app.route('/api/v1/fonctions')
     @requires_auth('get:fonctions')
+    @conditional('fonctions')
     def get_all_fonctions(current_user):
-        fonctions = Fonction.query.all()
+        view = Fieldset(request, Fonction)
+        fonctions, meta = paginate(Fonction.query.options(*view.options()), request, {
+            'id': Fonction.id, 'name': Fonction.fonction_name})
         data = []
         for fonction in fonctions:
-            data.append(fonction.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(fonction))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/fonctions/<int:fonction_id>', methods=["DELETE"])
     @requires_auth('delete:fonctions')
+    @transactional
     def delete_fonction_by_id(current_user, fonction_id):
         fonction = Fonction.query.filter_by(
             id=fonction_id).one_or_none()
@@ -496,6 +636,7 @@ def create_app(test_config=None):
             abort(404)
         try:
             fonction.delete()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'message': f'the fonction with ID {fonction_id} has been deleted'}), 200
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
@@ -505,25 +646,28 @@ def create_app(test_config=None):
     '''
     @app.route('/api/v1/typestructures/<int:typestructure_id>')
     @requires_auth('get:typestructures')
+    @conditional('typestructures', reference_cache)
     def get_typestructure_by_id(current_user, typestructure_id):
-        typestructure = TypeStructure.query.filter_by(
-            id=typestructure_id).one_or_none()
+        typestructure = reference_cache.get('typestructures', typestructure_id)
         if typestructure is None:
             abort(404)
-        return jsonify({'success': True, 'data': typestructure.json()}), 200
+        return jsonify({'success': True, 'data': Fieldset(request, TypeStructure).project(typestructure)}), 200
 
     @app.route('/api/v1/typestructures/<string:name>')
     @requires_auth('get:typestructures')
+    @conditional('typestructures')
     def get_typestructure_by_name(current_user, name):
-        typestructures = TypeStructure.query.filter(
-            TypeStructure.type_structure_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, TypeStructure)
+        typestructures = by_name(TypeStructure, TypeStructure.type_structure_name, name,
+                                 search_limit(request), view.options(*TypeStructure.jsonOptions()))
         data = []
         for typestructure in typestructures:
-            data.append(typestructure.json())
+            data.append(view(typestructure))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/typestructures', methods=["POST"])
     @requires_auth('post:typestructures')
+    @transactional
     def post_typestructures(current_user):
         data = request.get_json()
         name = data.get('name', None)
@@ -543,12 +687,14 @@ def create_app(test_config=None):
             if parentSt:
                 typestructure.parent_id = parent
             typestructure.insert()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': typestructure.json()}), 201
         except:
             abort(500)
 
     @app.route('/api/v1/typestructures/<int:typestructure_id>', methods=["PUT"])
     @requires_auth('put:typestructures')
+    @transactional
     def put_typestructure(current_user, typestructure_id):
         data = request.get_json()
         name = data.get('name', None)
@@ -570,21 +716,26 @@ def create_app(test_config=None):
             typestructure.type_structure_name = name
             typestructure.parent = parentSt
             typestructure.update()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'data': typestructure.json()}), 200
         except:
             abort(500)
 
     @app.route('/api/v1/typestructures')
     @requires_auth('get:typestructures')
+    @conditional('typestructures')
     def get_all_typestructures(current_user):
-        typestructures = TypeStructure.query.all()
+        view = Fieldset(request, TypeStructure)
+        typestructures, meta = paginate(TypeStructure.query.options(*view.options(*TypeStructure.jsonOptions())), request, {
+            'id': TypeStructure.id, 'name': TypeStructure.type_structure_name, 'parent': TypeStructure.parent_id})
         data = []
         for typestructure in typestructures:
-            data.append(typestructure.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(typestructure))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/typestructures/<int:typestructure_id>', methods=["DELETE"])
     @requires_auth('delete:typestructures')
+    @transactional
     def delete_typestructure_by_id(current_user, typestructure_id):
         typestructure = TypeStructure.query.filter_by(
             id=typestructure_id).one_or_none()
@@ -592,14 +743,17 @@ def create_app(test_config=None):
             abort(404)
         try:
             typestructure.delete()
+            reference_cache.invalidate()
             return jsonify({'success': True, 'message': f'the structure type with ID {typestructure_id} has been deleted'}), 200
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
     @app.route('/api/v1/typestructures/<int:typestructure_id>/fonctions')
     @requires_auth('get:fonctions')
+    @conditional('typestructures')
     def get_all_fonctions_by_typestructure(current_user, typestructure_id):
-        typestructure = TypeStructure.query.filter_by(
+        typestructure = TypeStructure.query.options(
+            selectinload(TypeStructure.fonctions).joinedload(TypeStructure_fonction.fonction)).filter_by(
             id=typestructure_id).one_or_none()
         if typestructure is None:
             abort(404)
@@ -610,8 +764,10 @@ def create_app(test_config=None):
 
     @app.route('/api/v1/typestructures/<int:typestructure_id>/structures')
     @requires_auth('get:structures')
+    @conditional('structures')
     def get_all_structures_by_typestructure(current_user, typestructure_id):
-        typestructure = TypeStructure.query.filter_by(
+        typestructure = TypeStructure.query.options(
+            selectinload(TypeStructure.structures).options(*Structure.shortJsonOptions())).filter_by(
             id=typestructure_id).one_or_none()
         if typestructure is None:
             abort(404)
@@ -620,8 +776,35 @@ def create_app(test_config=None):
             data.append(stucture.shortJson())
         return jsonify({'success': True, 'data': data}), 200
 
+    @app.route('/api/v1/typestructures/<int:typestructure_id>/ancestors')
+    @requires_auth('get:typestructures')
+    @conditional('typestructures')
+    def get_typestructure_ancestors(current_user, typestructure_id):
+        view = Fieldset(request, TypeStructure)
+        typestructure = TypeStructure.getByID(typestructure_id)
+        if typestructure is None:
+            abort(404)
+        data = []
+        for ancestor in typestructure.ancestors(*view.options(*TypeStructure.jsonOptions())):
+            data.append(view(ancestor))
+        return jsonify({'success': True, 'data': data}), 200
+
+    @app.route('/api/v1/typestructures/<int:typestructure_id>/descendants')
+    @requires_auth('get:typestructures')
+    @conditional('typestructures')
+    def get_typestructure_descendants(current_user, typestructure_id):
+        view = Fieldset(request, TypeStructure)
+        typestructure = TypeStructure.getByID(typestructure_id)
+        if typestructure is None:
+            abort(404)
+        data = []
+        for descendant in typestructure.descendants(*view.options(*TypeStructure.jsonOptions())).order_by(TypeStructure.path):
+            data.append(view(descendant))
+        return jsonify({'success': True, 'data': data}), 200
+
     @app.route('/api/v1/typestructures/<int:typestructure_id>/fonctions/<int:fonction_id>', methods=["POST"])
     @requires_auth('post:typestructures')
+    @transactional
     def add_fonction_to_typestructure(current_user, typestructure_id, fonction_id):
         data = request.get_json()
         nombre = data.get('nombre', None)
@@ -644,6 +827,7 @@ def create_app(test_config=None):
 
     @app.route('/api/v1/typestructures/<int:typestructure_id>/fonctions/<int:fonction_id>', methods=["DELETE"])
     @requires_auth('delete:typestructures')
+    @transactional
     def remove_fonction_to_typestructure(current_user, typestructure_id, fonction_id):
         typestructureFonction = TypeStructure_fonction.query.filter_by(
             typestructure_id=typestructure_id, fonction_id=fonction_id).one_or_none()
@@ -651,7 +835,7 @@ def create_app(test_config=None):
             abort(404)
         try:
             typestructureFonction.delete()
-            typestructure = TypeStructure.query.filter_by(
+            typestructure = TypeStructure.query.options(*TypeStructure.withFonctionsOptions()).filter_by(
                 id=typestructure_id).one_or_none()
             return jsonify({'success': True, 'data': typestructure.withFonctions()}), 200
         except:
@@ -662,6 +846,7 @@ def create_app(test_config=None):
     '''
     @app.route('/api/v1/structures', methods=["POST"])
     @requires_auth('post:structures')
+    @transactional
     def creat_structures(current_user):
         data = request.get_json()
         name = data.get('name', None)
@@ -672,9 +857,9 @@ def create_app(test_config=None):
         arrondissement = data.get('arrondissement', None)
         if name is None or adresse is None or contacts is None or typestructure is None or arrondissement is None:
             abort(400)
-        if TypeStructure.getByID(typestructure) is None:
+        if not reference_cache.exists('typestructures', typestructure):
             return jsonify({'success': False, 'error': 404, 'message': 'That structure type {} doesnt exist'.format(typestructure)}), 404
-        if Arrondissement.getByID(arrondissement) is None:
+        if not reference_cache.exists('arrondissements', arrondissement):
             return jsonify({'success': False, 'error': 404, 'message': 'That sub-division {} doesnt exist'.format(arrondissement)}), 404
         if Structure.getByName(name):
             return jsonify({'success': False, 'error': 400, 'message': 'A structure with the name << {} >> already exist'.format(name)}), 400
@@ -688,8 +873,34 @@ def create_app(test_config=None):
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
+    @app.route('/api/v1/structures/import', methods=["POST"])
+    @requires_auth('post:structures')
+    @transactional
+    def import_structures_batch(current_user):
+        try:
+            rows = read_rows(request)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': 400, 'message': str(e)}), 400
+        try:
+            inserted, errors = import_structures(
+                rows, partial=request.args.get('partial') == 'true')
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        if errors and not inserted:
+            return jsonify({'success': False, 'error': 422, 'message': 'Invalid data entry', 'inserted': 0, 'errors': errors}), 422
+        return jsonify({'success': True, 'inserted': inserted, 'errors': errors}), 201
+
+    @app.route('/api/v1/structures/export')
+    @requires_auth('get:structures')
+    def export_structures(current_user):
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in FORMATS:
+            abort(400)
+        return export_response(structures_query(), 'structures', export_format)
+
     @app.route('/api/v1/structures/<int:structure_id>', methods=["PUT"])
     @requires_auth('put:structures')
+    @transactional
     def update_structures(current_user, structure_id):
         data = request.get_json()
         name = data.get('name', None)
@@ -703,9 +914,9 @@ def create_app(test_config=None):
         structure = Structure.getByID(structure_id)
         if structure is None:
             abort(404)
-        if TypeStructure.getByID(typestructure) is None:
+        if not reference_cache.exists('typestructures', typestructure):
             return jsonify({'success': False, 'error': 404, 'message': 'That structure type {} doesnt exist'.format(typestructure)}), 404
-        if Arrondissement.getByID(arrondissement) is None:
+        if not reference_cache.exists('arrondissements', arrondissement):
             return jsonify({'success': False, 'error': 404, 'message': 'That sub-division {} doesnt exist'.format(arrondissement)}), 404
         if Structure.getByName(name) and structure.sturcture_name != name:
             return jsonify({'success': False, 'error': 400, 'message': 'A structure with the name << {} >> already exist'.format(name)}), 400
@@ -718,21 +929,26 @@ def create_app(test_config=None):
             if Structure.getByID(parent):
                 structure.parent_id = parent
             structure.update()
-            return {'success': True, 'data': structure.json()}, 201
+            return written(request, 201, data=structure)
         except Exception as e:
             return jsonify({'success': False, "error": 500, 'message': str(e)}), 500
 
     @app.route('/api/v1/structures')
     @requires_auth('get:structures')
+    @conditional('structures')
     def get_all_structures(current_user):
-        structures = Structure.query.all()
+        view = Fieldset(request, Structure)
+        structures, meta = paginate(Structure.query.options(*view.options(*Structure.jsonOptions())), request, {
+            'id': Structure.id, 'name': Structure.sturcture_name, 'type': Structure.typestructure_id,
+            'arrondissement': Structure.arrondissement_id, 'parent': Structure.parent_id})
         data = []
         for structure in structures:
-            data.append(structure.json())
-        return jsonify({'success': True, 'data': data}), 200
+            data.append(view(structure))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/structures/<int:structure_id>', methods=["DELETE"])
     @requires_auth('delete:structures')
+    @transactional
     def delete_structure_by_id(current_user, structure_id):
         structure = Structure.query.filter_by(
             id=structure_id).one_or_none()
@@ -746,66 +962,136 @@ def create_app(test_config=None):
 
     @app.route('/api/v1/structures/<int:structure_id>')
     @requires_auth('get:structures')
+    @conditional('structures')
     def get_structure_by_id(current_user, structure_id):
-        structure = Structure.query.filter_by(
-            id=structure_id).one_or_none()
+        view = Fieldset(request, Structure, Structure.jsonWithParentSchema)
+        structure = Structure.query.options(
+            *view.options(*Structure.jsonWithParentOptions()), *Structure.subStructureJsonOptions(),
+            selectinload(Structure.medias)).filter_by(id=structure_id).one_or_none()
+        if structure is None:
+            abort(404)
+        return jsonify({'success': True, 'data': view(structure), 'medias': structure.mediasJson(), 'substructures': structure.subStructureJson()}), 200
+
+    @app.route('/api/v1/structures/<int:structure_id>/ancestors')
+    @requires_auth('get:structures')
+    @conditional('structures')
+    def get_structure_ancestors(current_user, structure_id):
+        view = Fieldset(request, Structure)
+        structure = Structure.getByID(structure_id)
+        if structure is None:
+            abort(404)
+        data = []
+        for ancestor in structure.ancestors(*view.options(*Structure.jsonOptions())):
+            data.append(view(ancestor))
+        return jsonify({'success': True, 'data': data}), 200
+
+    @app.route('/api/v1/structures/<int:structure_id>/descendants')
+    @requires_auth('get:structures')
+    @conditional('structures')
+    def get_structure_descendants(current_user, structure_id):
+        view = Fieldset(request, Structure)
+        structure = Structure.getByID(structure_id)
         if structure is None:
             abort(404)
-        return jsonify({'success': True, 'data': structure.jsonWithParent(), 'medias': structure.mediasJson(), 'substructures': structure.subStructureJson()}), 200
+        structures, meta = paginate(structure.descendants(*view.options(*Structure.jsonOptions())), request, {
+            'id': Structure.id, 'name': Structure.sturcture_name, 'path': Structure.path, 'type': Structure.typestructure_id,
+            'arrondissement': Structure.arrondissement_id, 'parent': Structure.parent_id}, sortable=('id', 'name', 'path'))
+        data = []
+        for structure in structures:
+            data.append(view(structure))
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
 
     @app.route('/api/v1/structures/<string:name>')
     @requires_auth('get:structures')
+    @conditional('structures')
     def get_structure_by_name(current_user, name):
-        structures = Structure.query.filter(
-            Structure.structure_name.ilike(f'%{name}%')).all()
+        view = Fieldset(request, Structure)
+        structures = by_name(Structure, Structure.sturcture_name, name,
+                             search_limit(request), view.options(*Structure.jsonOptions()))
         data = []
         for structure in structures:
-            data.append(structure.json())
+            data.append(view(structure))
         return jsonify({'success': True, 'data': data}), 200
 
     @app.route('/api/v1/structures/<int:structure_id>/medias', methods=['POST'])
     @requires_auth('put:structures')
+    @transactional
     def set_structure_media(current_user, structure_id):
-        if not request.files["structure_image"]:
-            abort(400)
+        # the body is only read once the structure is known to exist
         structure = Structure.getByID(structure_id)
         if structure is None:
             abort(400)
+        picture = request.files.get("structure_image")
+        if not picture:
+            abort(400)
         try:
-            file_name = save_pic(
-                request.files["structure_image"], avatar=False)
-            file_path = request.host_url+"static/images/autres/"+file_name
-            media = Media(file_name=file_name, path_name=file_path,
-                          type_media='IMAGE', structure_id=structure_id)
+            file_name, content_hash = save_pic(picture)
+            media = Media(file_name=file_name, path_name=file_name, content_hash=content_hash,
+                          type_media='IMAGE', structure_id=structure_id, status='PROCESSING')
             media.insert()
-            return jsonify({'success': True, 'data': structure.json()}), 200
+            process_pic(media, avatar=False)
+            return written(request, 200, data=structure, media=media)
+        except ImageError as e:
+            return jsonify({'success': False, "error": e.status_code, 'message': str(e)}), e.status_code
         except Exception as e:
             return jsonify({'success': False, "error": 500, 'message': str(e)}), 500
 
     @app.route('/api/v1/structures/<int:structure_id>/medias/<int:media_id>', methods=['DELETE'])
     @requires_auth('put:structures')
+    @transactional
     def remove_structure_media(current_user, structure_id, media_id):
         structure = Structure.getByID(structure_id)
         media = Media.getByID(media_id)
 
         if structure is None:
             abort(400)
-        if media is None:
+        if media is None or media.structure_id != structure.id:
             abort(400)
         try:
-            structure.medias.remove(media)
-            structure.update()
-            os.remove(os.path.join(app.root_path,
-                      "static/images/autres", media.file_name))
+            media.delete()
+            remove_pic(media)
             return jsonify({'success': True, 'data': structure.json()}), 200
         except Exception as e:
             return jsonify({'success': False, "error": 500, 'message': str(e)}), 500
 
-    """ 
-    Manage members 
     """
+    Manage members
+    """
+    @app.route('/api/v1/membres')
+    @requires_auth('get:membres')
+    @conditional('membres')
+    def get_all_membres(current_user):
+        view = Fieldset(request, Membre, extra=('structures',))
+        membres, meta = paginate(Membre.query.options(*view.options(*Membre.jsonOptions())), request, {
+            'id': Membre.id, 'name': Membre.membre_fullname, 'genre': Membre.membre_genre,
+            'arrondissement': Membre.arrondissement_id, 'userid': Membre.user_id})
+        # the structures are a query of their own, skipped when they aren't asked for
+        structures = Membre.structuresByMembre([membre.id for membre in membres]) if view.wants('structures') else None
+        data = []
+        for membre in membres:
+            membreJson = view(membre)
+            if structures is not None:
+                membreJson['structures'] = structures[membre.id]
+            data.append(membreJson)
+        return jsonify({'success': True, 'data': data, 'meta': meta}), 200
+
+    @app.route('/api/v1/membres/<int:membre_id>')
+    @requires_auth('get:membres')
+    @conditional('membres')
+    def get_membre_by_id(current_user, membre_id):
+        view = Fieldset(request, Membre, extra=('structures',))
+        membre = Membre.query.options(*view.options(*Membre.jsonOptions())).filter_by(
+            id=membre_id).one_or_none()
+        if membre is None:
+            abort(404)
+        data = view(membre)
+        if view.wants('structures'):
+            data['structures'] = membre.myStructures()
+        return jsonify({'success': True, 'data': data}), 200
+
     @app.route('/api/v1/membres', methods=["POST"])
     @requires_auth('post:membres')
+    @transactional
     def create_membres(current_user):
         data = request.get_json()
         membre_fullname = data.get('fullname', None)
@@ -825,7 +1111,7 @@ def create_app(test_config=None):
         is_validated = validate_membre(**data)
         if is_validated is not True:
             return jsonify({'success': False, 'message': 'Invalid data entry', 'error': is_validated}), 409
-        if Arrondissement.getByID(arrondissement_id) is None:
+        if not reference_cache.exists('arrondissements', arrondissement_id):
             return jsonify({'success': False, 'error': 404, 'message': 'That sub-division {} doesnt exist'.format(arrondissement_id)}), 404
         if Membre.getByUserID(user_id):
             return jsonify({'success': False, 'error': 400, 'message': 'That account is already linked to another membre'}), 400
@@ -838,8 +1124,34 @@ def create_app(test_config=None):
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
+    @app.route('/api/v1/membres/import', methods=["POST"])
+    @requires_auth('post:membres')
+    @transactional
+    def import_membres_batch(current_user):
+        try:
+            rows = read_rows(request)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': 400, 'message': str(e)}), 400
+        try:
+            inserted, errors = import_membres(
+                rows, partial=request.args.get('partial') == 'true')
+        except Exception as e:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        if errors and not inserted:
+            return jsonify({'success': False, 'error': 422, 'message': 'Invalid data entry', 'inserted': 0, 'errors': errors}), 422
+        return jsonify({'success': True, 'inserted': inserted, 'errors': errors}), 201
+
+    @app.route('/api/v1/membres/export')
+    @requires_auth('get:membres')
+    def export_membres(current_user):
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in FORMATS:
+            abort(400)
+        return export_response(membres_query(), 'membres', export_format)
+
     @app.route('/api/v1/membres/<int:membre_id>', methods=["PUT"])
     @requires_auth('put:membres')
+    @transactional
     def update_membres(current_user, membre_id):
         data = request.get_json()
         membre_fullname = data.get('fullname', None)
@@ -859,7 +1171,7 @@ def create_app(test_config=None):
         is_validated = validate_membre(**data)
         if is_validated is not True:
             return jsonify({'success': False, 'message': 'Invalid data entry', 'error': is_validated}), 409
-        if Arrondissement.getByID(arrondissement_id) is None:
+        if not reference_cache.exists('arrondissements', arrondissement_id):
             return jsonify({'success': False, 'error': 404, 'message': 'That sub-division {} doesnt exist'.format(arrondissement_id)}), 404
         membre = Membre.getByID(membre_id)
         if membre is None:
@@ -879,12 +1191,13 @@ def create_app(test_config=None):
             membre.status_matrimonial = status_matrimonial
             membre.user_id = user_id
             membre.update()
-            return {'success': True, 'data': membre.json()}, 200
+            return written(request, 200, data=membre)
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
     @app.route('/api/v1/membres/<int:membre_id>', methods=["PATCH"])
     @requires_auth('put:membres')
+    @transactional
     def consecration_membres(current_user, membre_id):
         data = request.get_json()
         paroisse_id = data.get('paroisse', None)
@@ -900,12 +1213,13 @@ def create_app(test_config=None):
             membre.paroisse_consecration_id = paroisse_id
             membre.date_consecration = date_consecration
             membre.update()
-            return {'success': True, 'data': membre.json()}, 200
+            return written(request, 200, data=membre)
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
     @app.route('/api/v1/membres/<int:membre_id>/structures', methods=["POST"])
     @requires_auth('put:membres')
+    @transactional
     def structures_membres(current_user, membre_id):
         data = request.get_json()
         structure_id = data.get('structure_id', None)
@@ -916,7 +1230,7 @@ def create_app(test_config=None):
             return jsonify({'success': False, 'error': 400, 'message': 'The date {} is an invalid date'.format(date_affectation)}), 400
         if Structure.getByID(structure_id) is None:
             return jsonify({'success': False, 'error': 404, 'message': 'That structure {} doesnt exist'.format(structure_id)}), 404
-        if Fonction.getByID(fonction_id) is None:
+        if not reference_cache.exists('fonctions', fonction_id):
             return jsonify({'success': False, 'error': 404, 'message': 'That Fonction {} doesnt exist'.format(fonction_id)}), 404
 
         membre = Membre.getByID(membre_id)
@@ -926,47 +1240,59 @@ def create_app(test_config=None):
             structure_membre = StructureMembre(
                 membre_id=membre_id, structure_id=structure_id, fonction_id=fonction_id, date_affectation=date_affectation, actuel=actuel)
             structure_membre.insert()
-            return {'success': True, 'data': membre.json()}, 200
+            return written(request, 200, data=membre)
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
     @app.route('/api/v1/membres/<int:membre_id>/medias', methods=['POST'])
     @requires_auth('put:membres')
+    @transactional
     def set_membres_avatar(current_user, membre_id):
-        if not request.files["membre_image"]:
-            abort(400)
+        # the body is only read once the member is known to exist
         membre = Membre.getByID(membre_id)
         if membre is None:
             abort(404)
+        picture = request.files.get("membre_image")
+        if not picture:
+            abort(400)
         try:
-            file_name = save_pic(request.files["membre_image"])
-            file_path = request.host_url+"static/images/avatars/"+file_name
-            media = Media(file_name=file_name,
-                          path_name=file_path, type_media='IMAGE')
-            media.avatar_membre = membre
+            file_name, content_hash = save_pic(picture)
+            media = Media(file_name=file_name, path_name=file_name,
+                          content_hash=content_hash, type_media='IMAGE', status='PROCESSING')
+            membre.avatar = media
             media.insert()
-            return jsonify({'success': True, 'data': membre.json()}), 200
+            process_pic(media)
+            return written(request, 200, data=membre, media=media)
+        except ImageError as e:
+            return jsonify({'success': False, "error": e.status_code, 'message': str(e)}), e.status_code
         except Exception as e:
             return jsonify({'success': False, "error": 500, 'message': str(e)}), 500
 
     @app.route('/api/v1/membres/<int:membre_id>/medias/<int:media_id>', methods=['DELETE'])
     @requires_auth('put:membres')
+    @transactional
     def remove_membre_media(current_user, membre_id, media_id):
         media = Media.getByID(media_id)
         membre = Membre.getByID(membre_id)
         if membre is None:
             abort(404)
-        if media is None:
-            abort(400)
+        if media is None or media.id != membre.media_id:
+            abort(404)
         try:
             membre.avatar = None
             media.delete()
-            os.remove(os.path.join(app.root_path,
-                      "static/images/avatars", media.file_name))
+            remove_pic(media)
             return jsonify({'success': True, 'data': membre.json()}), 200
         except Exception as e:
             return jsonify({'success': False, "error": 500, 'message': str(e)}), 500
 
+    """
+    Serve the uploaded medias, public like the static files they used to be
+    """
+    @app.route('/media/<path:file_name>')
+    def get_media(file_name):
+        return send_media(file_name)
+
     '''
     Create error handlers for all expected errors 
     '''
@@ -994,6 +1320,14 @@ def create_app(test_config=None):
             "message": "Method Not Allowed"
         }), 405
 
+    @app.errorhandler(413)
+    def request_entity_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "Payload Too Large"
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -1020,4 +1354,18 @@ def create_app(test_config=None):
         response.status_code = ex.status_code
         return response
 
+    @app.cli.command('check-indexes')
+    @click.option('--database', is_flag=True, help='Check the tables of the database instead of the models.')
+    def check_indexes(database):
+        """Lists the foreign keys without an index, fails when there is one"""
+        if database:
+            found = unindexed_foreign_keys_in_database(db.engine)
+        else:
+            found = unindexed_foreign_keys(db.metadata)
+        for table, columns in found:
+            click.echo('{}({}) has no index'.format(table, ', '.join(columns)))
+        if found:
+            raise SystemExit(1)
+        click.echo('Every foreign key is indexed')
+
     return app
@@ -0,0 +1,204 @@
+"""Bulk Import Module
+
+Rows are sent as a JSON array (or {"data": [...]}) or as CSV, as the body
+with a text/csv content type or as a "file" upload, with the same keys as the
+POST endpoints. All the rows are validated first, the foreign keys and the
+unique names are checked with one IN query each, then the valid rows are
+inserted with a single executemany in one transaction.
+
+The report lists the errors by row number, 1 for the first data row. By
+default nothing is inserted when a row is invalid, with partial=True the
+valid rows are.
+"""
+import csv
+import io
+from dateutil import parser
+from sqlalchemy import bindparam, func, select
+from models.models import CacheVersion, Membre, Structure, User, commit, db, path_from_parents
+from models.reference_cache import reference_cache
+from .validate import validate_membre
+
+# CSV columns read as integers, the other values stay strings
+INT_FIELDS = ('userid', 'arrondissement', 'nbenfant', 'type', 'parent')
+GENRES = ('M', 'F')
+MARITAL_STATUSES = ('M', 'C', 'V')
+
+
+def coerce_csv(row):
+    data = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        value = value.strip() if value is not None else ''
+        if value == '':
+            value = None
+        elif key in INT_FIELDS:
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        data[key.strip()] = value
+    return data
+
+
+def read_rows(request):
+    """The rows of an import request, raises ValueError when they can't be read"""
+    if request.mimetype in ('text/csv', 'multipart/form-data'):
+        stream = request.stream
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if upload is None:
+                raise ValueError('The CSV must be uploaded as "file"')
+            stream = upload.stream
+        try:
+            reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig'))
+            return [coerce_csv(row) for row in reader]
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise ValueError('Invalid CSV: {}'.format(e))
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('data')
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValueError('Expected a JSON array of objects or a CSV file')
+    return data
+
+
+def add_error(errors, index, field, message):
+    errors.setdefault(index, {})[field] = message
+
+
+def existing(column, values):
+    """The values already in a column, one IN query"""
+    if not values:
+        return set()
+    return set(db.session.scalars(select(column).where(column.in_(values))))
+
+
+def unique_in_batch(rows, indexes, key, taken, errors, message):
+    """Flags the rows whose key is taken or repeats an earlier row"""
+    seen = set()
+    for i in indexes:
+        value = rows[i][key]
+        if value in taken or value in seen:
+            add_error(errors, i, key, message.format(value))
+        seen.add(value)
+
+
+def finish(rows, errors, partial, insert):
+    """Inserts the valid rows unless some are invalid and partial is False"""
+    report = [{'row': i + 1, 'errors': errors[i]} for i in sorted(errors)]
+    valid = [row for i, row in enumerate(rows) if i not in errors]
+    if not valid or (errors and not partial):
+        return 0, report
+    insert(valid)
+    commit()
+    return len(valid), report
+
+
+def import_membres(rows, partial=False):
+    """Creates the Membre rows, returns (number inserted, error report)"""
+    errors = {}
+    for i, row in enumerate(rows):
+        is_validated = validate_membre(**row)
+        if is_validated is not True:
+            errors[i] = is_validated
+            continue
+        if row['genre'] not in GENRES:
+            add_error(errors, i, 'genre', 'genre must be one of {}'.format(', '.join(GENRES)))
+        if row['statusm'] not in MARITAL_STATUSES:
+            add_error(errors, i, 'statusm', 'statusm must be one of {}'.format(
+                ', '.join(MARITAL_STATUSES)))
+        if not isinstance(row['nbenfant'], int):
+            add_error(errors, i, 'nbenfant', 'nbenfant must be an integer')
+        if not reference_cache.exists('arrondissements', row['arrondissement']):
+            add_error(errors, i, 'arrondissement', 'That sub-division {} doesnt exist'.format(
+                row['arrondissement']))
+
+    candidates = [i for i in range(len(rows)) if i not in errors]
+    user_ids = {rows[i]['userid'] for i in candidates}
+    users = existing(User.id, user_ids)
+    for i in candidates:
+        if rows[i]['userid'] not in users:
+            add_error(errors, i, 'userid', 'That account {} doesnt exist'.format(rows[i]['userid']))
+    unique_in_batch(rows, candidates, 'userid', existing(Membre.user_id, user_ids), errors,
+                    'That account {} is already linked to another membre')
+    unique_in_batch(rows, candidates, 'fullname',
+                    existing(Membre.membre_fullname, {rows[i]['fullname'] for i in candidates}), errors,
+                    'A membre named << {} >> already exist')
+
+    def insert(valid):
+        db.session.execute(Membre.__table__.insert(), [{
+            'membre_fullname': row['fullname'], 'membre_genre': row['genre'],
+            'membre_dob': parser.parse(str(row['dob'])), 'membre_pob': row['pob'],
+            'membre_mother': row['mother'], 'membre_father': row['father'],
+            'status_matrimonial': row['statusm'], 'membre_conjoint': row['conjoint'],
+            'membre_nbenfant': row['nbenfant'], 'membre_contacts': row['contacts'],
+            'membre_adresse': row['adresse'], 'arrondissement_id': row['arrondissement'],
+            'user_id': row['userid']} for row in valid])
+        # Core statements don't go through the flush that collects the written tables
+        CacheVersion.bumpOnCommit(Membre.__tablename__)
+
+    return finish(rows, errors, partial, insert)
+
+
+def import_structures(rows, partial=False):
+    """Creates the Structure rows under existing parents, returns (number inserted, error report)"""
+    errors = {}
+    for i, row in enumerate(rows):
+        for field in ('name', 'adresse', 'contacts', 'type', 'arrondissement'):
+            if row.get(field) is None:
+                add_error(errors, i, field, '{} is required'.format(field))
+        if i in errors:
+            continue
+        if not reference_cache.exists('typestructures', row['type']):
+            add_error(errors, i, 'type', 'That structure type {} doesnt exist'.format(row['type']))
+        if not reference_cache.exists('arrondissements', row['arrondissement']):
+            add_error(errors, i, 'arrondissement', 'That sub-division {} doesnt exist'.format(
+                row['arrondissement']))
+        if row.get('parent') is not None and not isinstance(row['parent'], int):
+            add_error(errors, i, 'parent', 'parent must be an integer')
+
+    candidates = [i for i in range(len(rows)) if i not in errors]
+    parents = existing(Structure.id, {rows[i]['parent'] for i in candidates
+                                      if rows[i].get('parent') is not None})
+    for i in candidates:
+        if rows[i].get('parent') is not None and rows[i]['parent'] not in parents:
+            add_error(errors, i, 'parent', 'That structure {} doesnt exist'.format(rows[i]['parent']))
+    # the parents still without a materialized path get it from their parent_id chain
+    table = Structure.__table__
+    parent_paths, rootless = {}, set()
+    if parents:
+        for parent_id in db.session.scalars(select(table.c.id).where(table.c.id.in_(parents), table.c.path.is_(None))):
+            try:
+                parent_paths[parent_id] = path_from_parents(db.session, table, parent_id)
+            except ValueError:
+                rootless.add(parent_id)
+    for i in candidates:
+        if rows[i].get('parent') in rootless:
+            add_error(errors, i, 'parent', 'That structure {} has no root, its parent chain is broken'.format(
+                rows[i]['parent']))
+    unique_in_batch(rows, candidates, 'name',
+                    existing(Structure.sturcture_name, {rows[i]['name'] for i in candidates}), errors,
+                    'A structure with the name << {} >> already exist')
+
+    def insert(valid):
+        names = [row['name'] for row in valid]
+        db.session.execute(table.insert(), [{
+            'sturcture_name': row['name'], 'structure_adresse': row['adresse'],
+            'structure_contacts': row['contacts'], 'typestructure_id': row['type'],
+            'arrondissement_id': row['arrondissement'], 'parent_id': row.get('parent')} for row in valid])
+        # the materialized paths the after_insert event would have set, the
+        # missing paths of the parents first, then two statements for the batch
+        if parent_paths:
+            db.session.execute(table.update().where(table.c.id == bindparam('parent'))
+                               .values(path=bindparam('parent_path')),
+                               [{'parent': parent_id, 'parent_path': path}
+                                for parent_id, path in parent_paths.items()])
+        db.session.execute(table.update().where(table.c.sturcture_name.in_(names), table.c.parent_id.is_(None))
+                           .values(path=func.concat('/', table.c.id, '/')))
+        parent = table.alias('parent')
+        db.session.execute(table.update().where(table.c.sturcture_name.in_(names), table.c.parent_id == parent.c.id)
+                           .values(path=func.concat(parent.c.path, table.c.id, '/')))
+        CacheVersion.bumpOnCommit(Structure.__tablename__)
+
+    return finish(rows, errors, partial, insert)
@@ -0,0 +1,191 @@
+"""Response Compression Module
+
+The JSON, NDJSON and CSV responses are compressed for the clients that
+accept it: brotli when the brotli package is installed (pip install brotli)
+and the client takes br, otherwise gzip. Set up by create_app with
+init_compression(app), configured from the environment:
+
+    COMPRESSION                 compress the responses (true), turn it off when
+                                a reverse proxy already does
+    COMPRESSION_MIN_SIZE        bytes under which a response is sent as is (1024),
+                                the headers would outweigh the saving
+    COMPRESSION_GZIP_LEVEL      1 to 9 (6)
+    COMPRESSION_BROTLI_QUALITY  0 to 11 (5)
+
+The streamed responses, the exports, are compressed chunk by chunk and
+flushed after each one, so the client still gets the rows as they are read.
+The medias are left alone, images don't compress.
+
+The body sizes before and after compression are counted per endpoint in
+histograms, for /api/v1/metrics; they are those of this worker.
+"""
+import os
+import threading
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION = os.environ.get('COMPRESSION', 'true').lower() in ('1', 'true', 'yes', 'on')
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html')
+
+# upper bounds of the histogram buckets in bytes, the last one is unbounded
+BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, None)
+
+
+class Gzip:
+    def __init__(self):
+        # wbits 31: the gzip container, with its header and crc
+        self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class Brotli:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+ENCODERS = {'br': Brotli, 'gzip': Gzip} if brotli is not None else {'gzip': Gzip}
+
+
+class SizeHistogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.bytes = 0
+
+    def add(self, size):
+        self.count += 1
+        self.bytes += size
+        for i, bound in enumerate(BUCKETS):
+            if bound is None or size <= bound:
+                self.counts[i] += 1
+                break
+
+    def json(self):
+        return {'count': self.count, 'bytes': self.bytes,
+                'buckets': [[bound, count] for bound, count in zip(BUCKETS, self.counts)]}
+
+
+class SizeStats:
+    """Histograms of the response bodies by endpoint, before and after compression"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, size, sent, encoding):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'uncompressed': SizeHistogram(), 'compressed': SizeHistogram(), 'encodings': {}}
+            stats['uncompressed'].add(size)
+            stats['compressed'].add(sent)
+            stats['encodings'][encoding] = stats['encodings'].get(encoding, 0) + 1
+
+    def json(self):
+        with self.lock:
+            return {endpoint: {'uncompressed': stats['uncompressed'].json(),
+                               'compressed': stats['compressed'].json(),
+                               'encodings': dict(stats['encodings']),
+                               'ratio': round(stats['compressed'].bytes / stats['uncompressed'].bytes, 3)
+                               if stats['uncompressed'].bytes else None}
+                    for endpoint, stats in self.endpoints.items()}
+
+
+size_stats = SizeStats()
+
+
+def compression_metrics():
+    return size_stats.json()
+
+
+def negotiated_encoding():
+    """The encoding to answer the request with, None for identity"""
+    return request.accept_encodings.best_match(list(ENCODERS))
+
+
+def compressible(response):
+    return (COMPRESSION and response.mimetype in COMPRESSIBLE and not response.direct_passthrough
+            and 200 <= response.status_code < 300 and response.status_code not in (204, 206)
+            and 'Content-Encoding' not in response.headers)
+
+
+def compressed_stream(chunks, encoding, endpoint):
+    """Compresses a streamed body, a flush per chunk keeps it streaming"""
+    encoder = ENCODERS[encoding]()
+    size = sent = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            size += len(chunk)
+            data = encoder.compress(chunk) + encoder.flush()
+            sent += len(data)
+            yield data
+        data = encoder.finish()
+        sent += len(data)
+        yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        size_stats.record(endpoint, size, sent, encoding)
+
+
+def compress_response(response):
+    endpoint = request.endpoint or 'unmatched'
+    encoding = None
+    if compressible(response):
+        # the identity answers vary too, a shared cache must not give them to the gzip clients
+        response.vary.add('Accept-Encoding')
+        encoding = negotiated_encoding()
+    elif response.status_code == 304:
+        # same Vary as the 200 it stands for
+        response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        if encoding is not None:
+            response.response = compressed_stream(response.response, encoding, endpoint)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+        return response
+    if response.direct_passthrough:
+        return response
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESSION_MIN_SIZE:
+        size_stats.record(endpoint, len(data), len(data), 'identity')
+        return response
+    encoder = ENCODERS[encoding]()
+    compressed = encoder.compress(data) + encoder.finish()
+    size_stats.record(endpoint, len(data), len(compressed), encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
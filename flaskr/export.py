@@ -0,0 +1,100 @@
+"""Export Module
+
+Full dumps of the membres and structures as CSV or NDJSON, one flat row per
+record. The rows come from a server side cursor EXPORT_BATCH at a time and
+are written to the response as they arrive, no ORM object is built and the
+memory used doesn't depend on the size of the tables.
+"""
+import csv
+import io
+import os
+from datetime import date
+from flask import Response, stream_with_context
+from sqlalchemy import and_, select
+from .json_provider import dumps
+from models.models import Arrondissement, Departement, Fonction, Membre, Region, Structure, StructureMembre, TypeStructure, db
+
+EXPORT_BATCH = int(os.environ.get('EXPORT_BATCH', 1000))
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def geography(model):
+    """The joins and columns from the arrondissement of a row up to its region"""
+    columns = [Arrondissement.arrondissement_name.label('arrondissement'), Departement.id.label('departement_id'),
+               Departement.departement_name.label('departement'), Region.id.label('region_id'),
+               Region.region_name.label('region')]
+
+    def join(stmt):
+        return stmt.join(Arrondissement, Arrondissement.id == model.arrondissement_id).join(
+            Departement, Departement.id == Arrondissement.departement_id).join(
+            Region, Region.id == Departement.region_id)
+    return columns, join
+
+
+def structures_query():
+    columns, join = geography(Structure)
+    return join(select(
+        Structure.id, Structure.sturcture_name.label('name'), Structure.structure_adresse.label('adresse'),
+        Structure.structure_contacts.label('contacts'), Structure.nombre_communicant, Structure.nombre_baptise,
+        Structure.date_creation, Structure.typestructure_id.label('type_id'),
+        TypeStructure.type_structure_name.label('type'), Structure.parent_id, Structure.path,
+        Structure.arrondissement_id, *columns).join(TypeStructure, TypeStructure.id == Structure.typestructure_id)
+    ).order_by(Structure.id)
+
+
+def membres_query():
+    """A row per current assignment of each membre, a single one without structure for the others"""
+    columns, join = geography(Membre)
+    return join(select(
+        Membre.id, Membre.membre_fullname.label('fullname'), Membre.membre_genre.label('genre'),
+        Membre.membre_dob.label('dob'), Membre.membre_pob.label('pob'), Membre.membre_mother.label('mother'),
+        Membre.membre_father.label('father'), Membre.status_matrimonial.label('statusm'),
+        Membre.membre_conjoint.label('conjoint'), Membre.membre_nbenfant.label('nbenfant'),
+        Membre.membre_contacts.label('contacts'), Membre.membre_adresse.label('adresse'),
+        Membre.date_consecration, Membre.paroisse_consecration_id.label('consecratoire_id'),
+        Membre.user_id.label('userid'), Membre.arrondissement_id, *columns,
+        StructureMembre.structure_id, Structure.sturcture_name.label('structure'),
+        StructureMembre.fonction_id, Fonction.fonction_name.label('fonction'), StructureMembre.date_affectation)
+        .outerjoin(StructureMembre, and_(StructureMembre.membre_id == Membre.id, StructureMembre.actuel.is_(True)))
+        .outerjoin(Structure, Structure.id == StructureMembre.structure_id)
+        .outerjoin(Fonction, Fonction.id == StructureMembre.fonction_id)
+    ).order_by(Membre.id, StructureMembre.structure_id)
+
+
+def plain(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def generate(stmt, export_format):
+    result = db.session.execute(stmt, execution_options={
+                                'stream_results': True}).yield_per(EXPORT_BATCH)
+    try:
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        for rows in result.partitions():
+            for row in rows:
+                if export_format == 'csv':
+                    writer.writerow([plain(value) for value in row])
+                else:
+                    buffer.write(dumps(dict(zip(columns, map(plain, row)))))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        result.close()
+
+
+def export_response(stmt, name, export_format):
+    """Streams the rows of stmt, export_format is one of FORMATS"""
+    response = Response(stream_with_context(generate(stmt, export_format)),
+                        mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(
+        name, export_format)
+    return response
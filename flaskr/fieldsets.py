@@ -0,0 +1,76 @@
+"""Sparse Fieldsets Module
+
+?fields=id,name keeps those keys of the returned objects and ?expand=type
+embeds only the listed relationships, the others are replaced by their id
+(the lists, such as medias, are left out). Without either parameter the
+objects are complete, as before.
+
+The SELECT of the rows is narrowed to the columns the kept fields read
+(load_only) and only the expanded relationships are loaded, so
+?fields=id,name&expand= is a single query of two columns.
+"""
+from flask import abort
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+
+def requested(request, name):
+    """The comma separated values of ?name=, None when it's absent"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return frozenset(item.strip() for item in value.split(',') if item.strip())
+
+
+class Fieldset:
+    """The ?fields= and ?expand= of a request for a model serialized with schema
+
+    extra lists the relationship keys the route adds itself to the objects,
+    such as the structures of the membres, see wants().
+    """
+
+    def __init__(self, request, model, schema=None, extra=()):
+        self.model = model
+        self.base = schema or model.jsonSchema
+        self.fields = requested(request, 'fields')
+        self.expand = requested(request, 'expand')
+        relations = set(self.base.relations()) | set(extra)
+        if self.fields is not None and self.fields - set(self.base.keys()) - set(extra):
+            abort(400)
+        if self.expand is not None and self.expand - relations:
+            abort(400)
+        self.schema = self.base.sparse(self.fields, self.expand)
+        self.complete = self.fields is None and self.expand is None
+
+    def wants(self, key):
+        """Whether the relationship key is kept and expanded"""
+        return (self.fields is None or key in self.fields) and (self.expand is None or key in self.expand)
+
+    def options(self, *default):
+        """The loader options of the rows, default when the objects are complete"""
+        if self.complete:
+            return list(default)
+        mapper = inspect(self.model)
+        options = [load_only(*[getattr(self.model, column) for column in sorted(self.schema.columns())]
+                             or [mapper.primary_key[0]])]
+        for key, relation in self.schema.relations().items():
+            attribute = getattr(self.model, relation)
+            related = attribute.property.mapper.class_
+            loader = selectinload(attribute) if attribute.property.uselist else joinedload(attribute)
+            # the options of the method the related rows are dumped with, such
+            # as shortJsonOptions() for a parent dumped with shortJson()
+            serializer = self.schema.serializer(key)
+            related_options = serializer + 'Options' if isinstance(serializer, str) else 'jsonOptions'
+            if hasattr(related, related_options):
+                loader = loader.options(*getattr(related, related_options)())
+            options.append(loader)
+        return options
+
+    def __call__(self, row):
+        return self.schema(row)
+
+    def project(self, data):
+        """The same narrowing for an object already serialized, such as the reference cache ones"""
+        if self.complete:
+            return data
+        return self.base.project(data, self.fields, self.expand)
@@ -0,0 +1,75 @@
+"""Conditional GET Module"""
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import make_response, request
+from models.models import CacheVersion
+
+MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 0))
+
+# tables whose writes change the representation of a resource, the first
+# one names the resource
+COLLECTIONS = {
+    'regions': ('regions',),
+    'departements': ('departements', 'regions'),
+    'arrondissements': ('arrondissements', 'departements', 'regions'),
+    'fonctions': ('fonctions',),
+    'typestructures': ('typestructures', 'typeStructure_fonction', 'fonctions'),
+    'structures': ('structures', 'typestructures', 'arrondissements', 'departements', 'regions', 'medias'),
+    'membres': ('membres', 'structuremembres', 'fonctions', 'structures', 'typestructures',
+                'arrondissements', 'departements', 'regions', 'medias'),
+}
+
+
+def cache_control(response):
+    if MAX_AGE:
+        response.headers['Cache-Control'] = 'private, max-age={}'.format(
+            MAX_AGE)
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Authorization'
+    return response
+
+
+def conditional(collection, cache=None):
+    """Answers If-None-Match / If-Modified-Since with a 304 without calling the handler
+
+    The weak ETag is derived from the URL and the CacheVersion counters of the
+    tables the resource is built from (one small query), so it changes as soon
+    as any of them is written. Goes under @requires_auth.
+
+    cache is the in-process cache the handler answers from (reference_cache),
+    its counter is read with the others and it is brought up to it first, so
+    a worker can't send its old body under the new ETag.
+    """
+    names = COLLECTIONS[collection]
+    if cache is not None:
+        names += (cache.version_name,)
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = CacheVersion.snapshot(names)
+            etag = hashlib.sha1(repr((request.full_path, versions)).encode()).hexdigest()
+            not_modified = request.if_none_match.contains_weak(etag)
+            if not request.if_none_match and last_modified and request.if_modified_since:
+                not_modified = last_modified.replace(
+                    microsecond=0) <= request.if_modified_since
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                if cache is not None:
+                    cache.refresh(versions[-1])
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Last-Modified has a one second resolution, leave it out while a
+            # write from the same second could still be missed
+            if last_modified and datetime.now(timezone.utc) - last_modified > timedelta(seconds=1):
+                response.last_modified = last_modified
+            return cache_control(response)
+
+        return wrapper
+    return conditional_decorator
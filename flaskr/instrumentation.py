@@ -0,0 +1,189 @@
+"""Request Instrumentation Module
+
+Measures every request: its wall time, the time spent in the database and
+the number of SQL statements it sent (cursor events of the engines), the
+time spent encoding the JSON (flaskr.json_provider), the authentication time
+(auth.requires_auth) and the size of the response. Set up by create_app with
+init_instrumentation(app, db), configured from the environment:
+
+    SERVER_TIMING       send the measures in a Server-Timing header (true),
+                        the browsers show it in their network panel
+    SLOW_REQUEST_MS     requests logged as slow above it (500), 0 for none
+    SLOW_STATEMENT_MS   statements logged as slow above it (100), 0 for none
+
+The statements are logged without their parameter values, only their
+types, the values can be personal data. The aggregates by endpoint and the
+slowest statements are in /api/v1/metrics, they are those of this worker.
+The time and size of a streamed response, an export, stop at its first
+byte.
+"""
+import logging
+import os
+import threading
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes', 'on')
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_STATEMENT_MS = float(os.environ.get('SLOW_STATEMENT_MS', 100))
+
+# distinct slow statements kept in the aggregates
+MAX_SLOW_STATEMENTS = 50
+
+
+def add_time(name, elapsed):
+    """Adds elapsed milliseconds to g.<name>_time of the current request"""
+    if has_app_context():
+        setattr(g, name + '_time', g.get(name + '_time', 0) + elapsed)
+
+
+def redacted(parameters):
+    """The parameters of a statement with their values replaced by their types"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return '{} rows of {}'.format(len(parameters), redacted(parameters[0]))
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class RequestStats:
+    """Aggregates of the requests by endpoint and of the slow statements"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.slow_statements = {}
+
+    def record(self, endpoint, status, wall, db_time, statements, serialization, size):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'count': 0, 'errors': 0, 'wall_ms': 0.0, 'max_wall_ms': 0.0, 'db_ms': 0.0,
+                    'statements': 0, 'max_statements': 0, 'serialization_ms': 0.0, 'bytes': 0}
+            stats['count'] += 1
+            stats['errors'] += status >= 500
+            stats['wall_ms'] += wall
+            stats['max_wall_ms'] = max(stats['max_wall_ms'], wall)
+            stats['db_ms'] += db_time
+            stats['statements'] += statements
+            stats['max_statements'] = max(stats['max_statements'], statements)
+            stats['serialization_ms'] += serialization
+            stats['bytes'] += size
+
+    def record_slow_statement(self, statement, elapsed):
+        with self.lock:
+            stats = self.slow_statements.get(statement)
+            if stats is None:
+                if len(self.slow_statements) >= MAX_SLOW_STATEMENTS:
+                    return
+                stats = self.slow_statements[statement] = {'count': 0, 'max_ms': 0.0}
+            stats['count'] += 1
+            stats['max_ms'] = max(stats['max_ms'], round(elapsed, 2))
+
+    def json(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                count = stats['count']
+                endpoints[endpoint] = {
+                    'count': count, 'errors': stats['errors'],
+                    'mean_ms': round(stats['wall_ms'] / count, 2), 'max_ms': round(stats['max_wall_ms'], 2),
+                    'mean_db_ms': round(stats['db_ms'] / count, 2),
+                    'mean_statements': round(stats['statements'] / count, 2),
+                    'max_statements': stats['max_statements'],
+                    'mean_serialization_ms': round(stats['serialization_ms'] / count, 2),
+                    'mean_bytes': round(stats['bytes'] / count)}
+            slow = sorted(({'statement': statement, **stats} for statement, stats in self.slow_statements.items()),
+                          key=lambda stats: stats['max_ms'], reverse=True)
+            return {'endpoints': endpoints, 'slow_statements': slow}
+
+
+request_stats = RequestStats()
+
+
+def request_metrics():
+    return request_stats.json()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = (time.perf_counter() - conn.info['query_started'].pop()) * 1000
+    if has_app_context():
+        g.db_time = g.get('db_time', 0) + elapsed
+        g.statements = g.get('statements', 0) + 1
+    if SLOW_STATEMENT_MS and elapsed > SLOW_STATEMENT_MS:
+        request_stats.record_slow_statement(statement, elapsed)
+        logger.warning('slow statement %.1fms: %s parameters: %s', elapsed, statement, redacted(parameters))
+
+
+def handle_error(context):
+    # the failed statement gets no after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+# the engines already instrumented, the replicas share the listeners
+instrumented = set()
+
+
+def instrument_engines(engines):
+    for engine in engines:
+        if engine not in instrumented:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(engine, 'handle_error', handle_error)
+            instrumented.add(engine)
+
+
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+def server_timing(wall, db_time, statements, serialization, auth):
+    metrics = ['total;dur={:.1f}'.format(wall),
+               'db;dur={:.1f};desc="{} statements"'.format(db_time, statements)]
+    if auth is not None:
+        metrics.append('auth;dur={:.1f}'.format(auth))
+    if serialization:
+        metrics.append('json;dur={:.1f}'.format(serialization))
+    return ', '.join(metrics)
+
+
+def record_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    wall = (time.perf_counter() - started) * 1000
+    db_time, statements = g.get('db_time', 0), g.get('statements', 0)
+    serialization = g.get('serialization_time', 0)
+    size = response.content_length or 0
+    endpoint = request.endpoint or 'unmatched'
+    request_stats.record(endpoint, response.status_code, wall, db_time, statements, serialization, size)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(
+            wall, db_time, statements, serialization, g.get('auth_time'))
+        # the front end is on another origin (CORS), without it the browsers hide the header
+        response.headers['Timing-Allow-Origin'] = '*'
+    if SLOW_REQUEST_MS and wall > SLOW_REQUEST_MS:
+        logger.warning('slow request %s %s %d: %.1fms, db %.1fms in %d statements, json %.1fms, %d bytes',
+                       request.method, request.path, response.status_code, wall, db_time, statements,
+                       serialization, size)
+    return response
+
+
+def init_instrumentation(app, db):
+    """To call before init_compression, the after_request functions run in the
+    reverse order so the time includes the compression and the size is the one sent"""
+    with app.app_context():
+        instrument_engines(db.engines.values())
+    app.before_request(start_timer)
+    app.after_request(record_request)
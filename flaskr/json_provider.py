@@ -0,0 +1,64 @@
+"""JSON Provider Module
+
+app.json of the application: dates and datetimes are written as ISO 8601
+strings, and the responses are encoded by orjson when it's installed (pip
+install orjson), several times faster than the json module on the large
+lists. Without it the stdlib encoder is used, with the same output apart
+from the whitespace and the escaping of non ASCII characters. The encoding
+time of a response is added to g.serialization_time (flaskr.instrumentation).
+"""
+import json
+import time
+from datetime import date
+from flask.json.provider import DefaultJSONProvider
+from .instrumentation import add_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(value):
+    """The types orjson and json don't know, date and datetime are only seen by json"""
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+def dumps(value):
+    """Compact JSON of a value as a str, the keys are not sorted"""
+    if orjson is not None:
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(',', ':'))
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+
+    def options(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {'indent', 'separators'}:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options('indent' in kwargs)).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            started = time.perf_counter()
+            response = super().response(*args, **kwargs)
+            add_time('serialization', (time.perf_counter() - started) * 1000)
+            return response
+        started = time.perf_counter()
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        # bytes straight into the response, without the str round trip
+        body = orjson.dumps(obj, default=self.default, option=self.options(indent)) + b'\n'
+        add_time('serialization', (time.perf_counter() - started) * 1000)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,153 @@
+"""Media Storage Module
+
+Uploaded files are stored under content addressed keys (the sha256 of the
+upload plus its extension, derivatives append _<size>.<format>), so the same
+photo is stored and processed once however many Media rows point to it.
+"""
+import mimetypes
+import os
+import tempfile
+from flask import current_app as app, abort, make_response, redirect, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional, only needed with MEDIA_STORE=s3
+    boto3 = None
+
+MEDIA_STORE = os.environ.get('MEDIA_STORE', 'local')
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+# e.g. http://localhost:9000 for a local MinIO
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')
+# where the media urls point to, e.g. https://cdn.example.org/media/ (default:
+# the /media/ route of the API, or the bucket for S3)
+MEDIA_BASE_URL = os.environ.get('MEDIA_BASE_URL')
+# hand the file over to the web server: 'x-sendfile' (Apache, lighttpd) or the
+# internal location nginx serves MEDIA_ROOT from with X-Accel-Redirect
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE')
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+# file names are content hashes, a file never changes once it has a url
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+
+class LocalMediaStore:
+    """Files in a folder, served by send_media()"""
+    base_url = None
+
+    def __init__(self, root):
+        self.root = root
+        # temporary files live next to the store so save() is an atomic rename
+        self.tmp = os.path.join(root, '.tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def temp_file(self, suffix=''):
+        fd, file_path = tempfile.mkstemp(suffix=suffix, dir=self.tmp)
+        os.close(fd)
+        return file_path
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def save(self, key, file_path):
+        """Moves a local file into the store"""
+        os.replace(file_path, self.path(key))
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3MediaStore:
+    """Objects in an S3 bucket, or in any S3 compatible server (MinIO...)"""
+
+    def __init__(self, bucket, endpoint_url=None, public_url=None):
+        if boto3 is None:
+            raise RuntimeError('MEDIA_STORE=s3 needs the boto3 package')
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.base_url = (public_url or '{}/{}'.format(
+            endpoint_url or 'https://{}.s3.amazonaws.com'.format(bucket), bucket)).rstrip('/') + '/'
+
+    def path(self, key):
+        return None
+
+    def temp_file(self, suffix=''):
+        fd, file_path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        return file_path
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def save(self, key, file_path):
+        self.client.upload_file(file_path, self.bucket, key)
+        os.remove(file_path)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+def get_store(flask_app=None):
+    """The store configured for the application, created on first use"""
+    flask_app = flask_app or app._get_current_object()
+    store = flask_app.extensions.get('media_store')
+    if store is None:
+        if MEDIA_STORE == 's3':
+            store = S3MediaStore(S3_BUCKET, S3_ENDPOINT_URL, S3_PUBLIC_URL)
+        else:
+            store = LocalMediaStore(MEDIA_ROOT or os.path.join(
+                flask_app.root_path, 'media'))
+        flask_app.extensions['media_store'] = store
+    return store
+
+
+def media_base_url(flask_app):
+    """MEDIA_BASE_URL, or the bucket url, None to use the /media/ route of the request host (of SERVER_NAME outside of a request)"""
+    if MEDIA_BASE_URL:
+        return MEDIA_BASE_URL.rstrip('/') + '/'
+    return get_store(flask_app).base_url
+
+
+def send_media(file_name):
+    """Response for a stored file, with Range support and immutable caching
+
+    With MEDIA_SENDFILE the body is left to the web server, otherwise
+    send_from_directory streams it with wsgi.file_wrapper when available.
+    """
+    store = get_store()
+    if store.path(file_name) is None:
+        return redirect(store.base_url + file_name)
+    if MEDIA_SENDFILE and MEDIA_SENDFILE != 'x-sendfile':
+        file_path = safe_join(store.root, file_name)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX + file_name
+        response.mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    else:
+        # X-Sendfile is added by send_file itself when app.use_x_sendfile is set
+        response = send_from_directory(store.root, file_name, conditional=True, etag=file_name,
+                                       max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
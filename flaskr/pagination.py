@@ -0,0 +1,113 @@
+"""Pagination Module"""
+import base64
+import binascii
+import json
+from flask import abort
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(values):
+    """Encodes the sort key of the last row of a page into an opaque cursor"""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor, aborts with 400 if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        abort(400)
+    if not isinstance(values, list) or len(values) != 2:
+        abort(400)
+    return values
+
+
+def coerce_arg(column, value):
+    """Converts a query string value to the python type of the column"""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is bool:
+        return value.lower() in ('1', 'true', 'yes')
+    try:
+        return python_type(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def paginate(query, request, fields, sortable=('id', 'name')):
+    """Filters, orders and limits a query in SQL
+
+    fields maps the public argument names to columns and must contain 'id'.
+    Any of them can be used as an equality filter (comma separated values
+    become an IN), the ones listed in sortable can be used with ?sort=name
+    or ?sort=-name. Pages are walked with ?cursor= (keyset, WHERE (key, id) > ...)
+    or with the legacy ?page= (OFFSET). Returns the rows and the page metadata.
+    """
+    for name, column in fields.items():
+        value = request.args.get(name)
+        if value is None:
+            continue
+        values = [coerce_arg(column, v) for v in value.split(',')]
+        if len(values) == 1:
+            query = query.filter(column == values[0])
+        else:
+            query = query.filter(column.in_(values))
+
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in sortable or sort not in fields:
+        abort(400)
+    sort_column = fields[sort]
+    id_column = fields['id']
+
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    meta = {'limit': limit, 'sort': request.args.get('sort', 'id')}
+    if request.args.get('count', 'true').lower() not in ('0', 'false', 'no'):
+        meta['total'] = query.order_by(None).count()
+
+    if sort_column is id_column:
+        key = (id_column,)
+    else:
+        key = (sort_column, id_column)
+    if descending:
+        query = query.order_by(*[column.desc() for column in key])
+    else:
+        query = query.order_by(*key)
+
+    cursor = request.args.get('cursor')
+    page = request.args.get('page', type=int)
+    if cursor:
+        last = decode_cursor(cursor)
+        if len(key) == 1:
+            condition = id_column < last[1] if descending else id_column > last[1]
+        else:
+            bound = tuple_(*[coerce_arg(column, str(value))
+                             for column, value in zip(key, last)])
+            condition = tuple_(*key) < bound if descending else tuple_(*key) > bound
+        query = query.filter(condition)
+    elif page:
+        if page < 1:
+            abort(400)
+        meta['page'] = page
+        query = query.offset((page - 1) * limit)
+
+    rows = query.limit(limit + 1).all()
+    meta['next_cursor'] = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        meta['next_cursor'] = encode_cursor(
+            [getattr(last, sort_column.key), getattr(last, id_column.key)])
+    return rows, meta
@@ -0,0 +1,49 @@
+"""Write Representation Module
+
+The write endpoints answer with the complete objects they changed, their
+relationships included. A client that only needs to know the write went
+through asks for less with the Prefer header of RFC 7240:
+
+    Prefer: return=minimal          the id and the fields the request wrote,
+                                    the relationships as their id
+    Prefer: return=representation   the complete objects (the default)
+
+?return=minimal or ?return=representation does the same for the clients that
+can't set the header, and wins over it. Unknown values are ignored, as RFC
+7240 asks, and the preference followed is echoed in Preference-Applied.
+"""
+from models.models import written_columns
+
+RETURNS = ('minimal', 'representation')
+
+
+def preferred_return(request):
+    """minimal, representation, or None when the client has no preference"""
+    value = request.args.get('return')
+    if value in RETURNS:
+        return value
+    for preference in request.headers.get('Prefer', '').split(','):
+        name, _, value = preference.split(';')[0].partition('=')
+        value = value.strip().strip('"')
+        if name.strip().lower() == 'return' and value in RETURNS:
+            return value
+    return None
+
+
+def minimal(row):
+    """The id and the jsonSchema keys of row whose columns were written, without loading any relationship"""
+    schema = type(row).jsonSchema
+    columns = written_columns(row)
+    keys = {key for key, (read, relation, foreign_key) in schema.meta.items()
+            if key == 'id' or columns.intersection(read)}
+    return schema.sparse(keys, expand=())(row)
+
+
+def written(request, status, **rows):
+    """The response of a write, {'success': True, key: json() of the row} for each row"""
+    preference = preferred_return(request)
+    body = {'success': True}
+    for key, row in rows.items():
+        body[key] = minimal(row) if preference == 'minimal' else row.json()
+    headers = {'Preference-Applied': 'return=' + preference} if preference else {}
+    return body, status, headers
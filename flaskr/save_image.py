@@ -1,29 +1,246 @@
-import secrets
+import hashlib
 import os
-from PIL import Image
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
 from flask import current_app as app
+from sqlalchemy import func, select
+from flaskr.media_store import get_store
+from models.models import Media, after_commit, db
 
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+# where images were saved before the content addressed store, still used to delete them
+FOLDERS = ("static/images/avatars", "static/images/autres")
+# derivatives produced for every image, name:longest side
+IMAGE_SIZES = [(name, int(size)) for name, size in (
+    item.split(':') for item in os.environ.get('IMAGE_SIZES', 'thumb:200,small:480,medium:1024').split(','))]
+IMAGE_FORMATS = os.environ.get('IMAGE_FORMATS', 'jpeg,webp').split(',')
+SAVE_OPTIONS = {
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+}
+CHUNK_SIZE = 64 * 1024
+# bytes of a whole request, larger uploads are refused with a 413 before being read
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
+# decoded size limit, a small file can still expand to gigabytes of pixels
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40_000_000))
+# accepted formats and the extension they are stored with
+IMAGE_TYPES = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
 
-def save_pic(picture, avatar=True):
-    """Saves an image to disk"""
-    file_name = secrets.token_hex(8) + os.path.splitext(picture.filename)[1]
-    if not os.path.isdir(os.path.join(app.root_path, 'static')):
-        os.mkdir(os.path.join(app.root_path, "static"))
-        os.mkdir(os.path.join(app.root_path, "static/images"))
-        os.mkdir(os.path.join(app.root_path, "static/images/avatars"))
-        os.mkdir(os.path.join(app.root_path, "static/images/autres"))
-    if not os.path.isdir(os.path.join(app.root_path, 'static/images')):
-        os.mkdir(os.path.join(app.root_path, "static/images"))
-        os.mkdir(os.path.join(app.root_path, "static/images/avatars"))
-        os.mkdir(os.path.join(app.root_path, "static/images/autres"))
-    if not os.path.isdir(os.path.join(app.root_path, 'static/images/avatars')):
-        os.mkdir(os.path.join(app.root_path, "static/images/avatars"))
-    if not os.path.isdir(os.path.join(app.root_path, 'static/images/autres')):
-        os.mkdir(os.path.join(app.root_path, "static/images/autres"))
-    file_path = os.path.join(app.root_path, "static/images/avatars",
-                             file_name) if avatar else os.path.join(app.root_path, "static/images/autres", file_name)
-    picture = Image.open(picture)
-    if avatar:
-        picture.thumbnail((200, 200))
-    picture.save(file_path)
-    return file_name
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+logger = logging.getLogger(__name__)
+executor = None
+
+
+class ImageError(Exception):
+    """An upload that is not an image we accept"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_pic(file_path):
+    """Reads the format and the dimensions from the header only, nothing is decoded
+
+    Returns the extension to store the image with.
+    """
+    try:
+        with Image.open(file_path) as picture:
+            image_format, (width, height) = picture.format, picture.size
+    except Image.DecompressionBombError:
+        raise ImageError('Image too large', 413)
+    except Exception:
+        raise ImageError('Not an image', 415)
+    if image_format not in IMAGE_TYPES:
+        raise ImageError('Unsupported image format {}'.format(image_format), 415)
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageError('Image too large, {}x{} pixels'.format(width, height), 413)
+    return IMAGE_TYPES[image_format]
+
+
+def save_pic(picture):
+    """Stores the uploaded image as it is under the sha256 of its content
+
+    The upload is hashed while it is copied to a temporary file, then its
+    header is checked; when the store already has that content nothing is
+    written. The content is locked until the transaction commits the Media,
+    so remove_pic can't delete the files it relies on in the meantime.
+    Raises ImageError for anything but a reasonably sized image. Returns
+    (file name, content hash).
+    """
+    store = get_store()
+    tmp_path = store.temp_file()
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as target:
+            for chunk in iter(lambda: picture.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                target.write(chunk)
+        ext = sniff_pic(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    content_hash = digest.hexdigest()
+    file_name = content_hash + ext
+    lock_content(db.session, content_hash)
+    if store.exists(file_name):
+        os.remove(tmp_path)
+    else:
+        store.save(file_name, tmp_path)
+    return file_name, content_hash
+
+
+def lock_content(connection, content_hash):
+    """Serializes the uploads and the deletes of the same content until the transaction ends"""
+    connection.execute(select(func.pg_advisory_xact_lock(func.hashtext(content_hash))))
+
+
+def variant_name(content_hash, name, image_format):
+    return '{}_{}.{}'.format(content_hash, name, image_format)
+
+
+def variant_files(variants):
+    return [value for variant in (variants or {}).values()
+            for key, value in variant.items() if key not in ('width', 'height')]
+
+
+def save_variant(store, picture, file_name):
+    ext = os.path.splitext(file_name)[1].lstrip('.').lower()
+    options = SAVE_OPTIONS.get('jpeg' if ext == 'jpg' else ext, {})
+    if options.get('format') == 'JPEG' and picture.mode != 'RGB':
+        picture = picture.convert('RGB')
+    tmp_path = store.temp_file('.' + ext)
+    picture.save(tmp_path, **options)
+    store.save(file_name, tmp_path)
+
+
+def resize_pic(store, file_name, content_hash):
+    """Produces the IMAGE_SIZES x IMAGE_FORMATS derivatives of an image
+
+    JPEGs are decoded with draft() at the smallest power of two scale that
+    still covers the largest derivative, each size is then reduced from the
+    previous one. Derivatives already in the store are not encoded again.
+    Returns {size name: {'width', 'height', format: file name}}.
+    """
+    file_path = store.path(file_name)
+    if file_path is None:
+        with store.open(file_name) as source:
+            file_path = BytesIO(source.read())
+    picture = Image.open(file_path)
+    original = picture.size
+    sizes = sorted([item for item in IMAGE_SIZES if item[1] < max(original)],
+                   key=lambda item: -item[1])
+    if not sizes:
+        sizes = [min(IMAGE_SIZES, key=lambda item: item[1])]
+    largest = min(sizes[0][1], max(original))
+    picture.draft('RGB', (largest, largest))
+    picture = ImageOps.exif_transpose(picture)
+    picture.load()
+
+    variants = {}
+    for name, size in sizes:
+        picture.thumbnail((size, size))
+        variant = {'width': picture.width, 'height': picture.height}
+        for image_format in IMAGE_FORMATS:
+            key = variant_name(content_hash, name, image_format)
+            if not store.exists(key):
+                save_variant(store, picture, key)
+            variant[image_format] = key
+        variants[name] = variant
+    return variants
+
+
+def avatar_file(variants):
+    """Avatars are shown at their smallest size"""
+    smallest = min(variants.values(), key=lambda variant: variant['width'])
+    return smallest[IMAGE_FORMATS[0]]
+
+
+def mark_failed(media_id):
+    """Sets a Media still PROCESSING to FAILED, in a transaction of its own"""
+    try:
+        Media.query.filter(Media.id == media_id, Media.status == 'PROCESSING').update(
+            {'status': 'FAILED'}, synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        logger.exception('marking media %s failed failed', media_id)
+        db.session.rollback()
+
+
+def process_job(flask_app, media_id, avatar):
+    with flask_app.app_context():
+        # the executor would keep the exception in a future nobody reads
+        try:
+            media = Media.getByID(media_id)
+            if media is None:
+                return
+            variants = resize_pic(get_store(), media.file_name, media.content_hash)
+            media.status = 'READY'
+            media.variants = variants
+            if avatar and variants:
+                media.path_name = avatar_file(variants)
+            db.session.commit()
+        except Exception:
+            logger.exception('processing media %s failed', media_id)
+            db.session.rollback()
+            mark_failed(media_id)
+
+
+def process_pic(media, avatar=True):
+    """Gives a new Media the derivatives of an identical upload, or queues their processing
+
+    The Media row must be inserted with the PROCESSING status, it ends up
+    READY (at once when the same content was already processed) or FAILED.
+    The job is queued once the row is committed.
+    """
+    twin = Media.query.filter(Media.content_hash == media.content_hash, Media.id != media.id,
+                              Media.status == 'READY', Media.variants.isnot(None)).first()
+    if twin is not None:
+        media.status = 'READY'
+        media.variants = twin.variants
+        if avatar:
+            media.path_name = avatar_file(twin.variants)
+        media.update()
+        return
+    flask_app, media_id = app._get_current_object(), media.id
+    after_commit(lambda: submit(process_job, flask_app, media_id, avatar))
+
+
+def submit(*args):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=IMAGE_WORKERS, thread_name_prefix='images')
+    return executor.submit(*args)
+
+
+def remove_pic(media):
+    """Deletes the files of a deleted Media, once committed and if no other Media references them"""
+    names = [media.file_name] + variant_files(media.variants)
+    content_hash, path_name = media.content_hash, media.path_name
+    root_path = app.root_path
+
+    def remove():
+        if content_hash is None:
+            folder = FOLDERS[0] if '/avatars/' in path_name else FOLDERS[1]
+            for name in names:
+                try:
+                    os.remove(os.path.join(root_path, folder, name))
+                except FileNotFoundError:
+                    pass
+            return
+        # a transaction of its own, the lock waits for an upload of the same
+        # content to commit its Media and is kept while the files go
+        with db.engine.begin() as connection:
+            lock_content(connection, content_hash)
+            if connection.scalar(select(func.count()).select_from(Media.__table__).where(
+                    Media.content_hash == content_hash)):
+                return
+            store = get_store()
+            for name in names:
+                store.delete(name)
+
+    after_commit(remove)
@@ -0,0 +1,86 @@
+"""Search Module
+
+Accent and case insensitive name lookups for the autocomplete fields. The
+names are compared through f_unaccent() so "Ebolowa" finds "Ébolowa", the
+expression GIN trigram indexes of the name columns serve both the substring
+matches and, for the typos, the word similarity ones (pg_trgm %>), and every
+query is bounded by a LIMIT.
+
+Results are ranked: exact names, then names starting with the text, then by
+word similarity, shorter names first.
+"""
+import os
+from flask import abort
+from sqlalchemy import String, case, func, literal, select, union_all
+from models.models import Arrondissement, Departement, Fonction, Membre, Region, Structure, TypeStructure, db
+
+SEARCH_LIMIT = int(os.environ.get('SEARCH_LIMIT', 10))
+MAX_SEARCH_LIMIT = 50
+
+# searched type: (model, name column), the type is also the get:<type> permission
+TYPES = {
+    'regions': (Region, Region.region_name),
+    'departements': (Departement, Departement.departement_name),
+    'arrondissements': (Arrondissement, Arrondissement.arrondissement_name),
+    'fonctions': (Fonction, Fonction.fonction_name),
+    'typestructures': (TypeStructure, TypeStructure.type_structure_name),
+    'structures': (Structure, Structure.sturcture_name),
+    'membres': (Membre, Membre.membre_fullname),
+}
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def unaccent(value):
+    return func.f_unaccent(value, type_=String)
+
+
+def name_matches(column, name):
+    """The WHERE clause of a search, uses the trigram index of the column"""
+    return (unaccent(column).ilike('%' + unaccent(escape_like(name)) + '%')
+            | unaccent(column).op('%>')(unaccent(name)))
+
+
+def ranking(column, name):
+    """(exact or prefix rank, word similarity) of a name, higher is better"""
+    unaccented = func.lower(unaccent(column))
+    rank = case((unaccented == func.lower(unaccent(name)), 2),
+                (unaccented.like(func.lower(unaccent(escape_like(name))) + '%'), 1),
+                else_=0)
+    return rank, func.word_similarity(unaccent(name), unaccent(column))
+
+
+def search_limit(request):
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_SEARCH_LIMIT)
+
+
+def by_name(model, column, name, limit, options=()):
+    """The rows of model matching name, best first"""
+    rank, score = ranking(column, name)
+    return model.query.options(*options).filter(name_matches(column, name)).order_by(
+        rank.desc(), score.desc(), func.length(column), model.id).limit(limit).all()
+
+
+def search(name, types, limit):
+    """[{type, id, name, score}] of the best matches across types, one query"""
+    selects = []
+    for type_name in types:
+        model, column = TYPES[type_name]
+        rank, score = ranking(column, name)
+        # each type is limited on its own so its index scan stops early
+        selects.append(select(literal(type_name).label('type'), model.id.label('id'), column.label('name'),
+                              rank.label('rank'), score.label('score'))
+                       .where(name_matches(column, name))
+                       .order_by(rank.desc(), score.desc(), func.length(column)).limit(limit))
+    if not selects:
+        return []
+    matches = union_all(*selects).subquery()
+    rows = db.session.execute(select(matches).order_by(
+        matches.c.rank.desc(), matches.c.score.desc(), func.length(matches.c.name)).limit(limit))
+    return [{'type': row.type, 'id': row.id, 'name': row.name, 'score': round(row.score, 3)}
+            for row in rows]
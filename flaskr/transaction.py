@@ -0,0 +1,33 @@
+"""Request Transaction Module"""
+from functools import wraps
+from flask import make_response
+from models.models import unit_of_work
+
+
+class Rollback(Exception):
+    """Leaves the unit of work without committing, carries the response"""
+
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+def transactional(f):
+    """Runs a handler in one unit of work, committed once at the end
+
+    The writes are rolled back when the handler raises or answers with an
+    error status (>= 400), the exception is raised again. Goes under
+    @requires_auth.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            with unit_of_work():
+                response = make_response(f(*args, **kwargs))
+                if response.status_code >= 400:
+                    raise Rollback(response)
+        except Rollback as rollback:
+            return rollback.response
+        return response
+
+    return wrapper
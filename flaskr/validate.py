@@ -63,7 +63,7 @@ def validate_user(**args):
 
 def validate_membre(**args):
     """Membre Validator"""
-    if not args.get('userid') or not args.get('fullname') or not args.get('genre') or not args.get('dob') or not args.get('pob') or not args.get('genre') or not args.get('dob') or not args.get('pob') or not args.get('mother') or not args.get('father') or not args.get('statusm') or not args.get('conjoint') or not args.get('nbenfant') or not args.get('contacts') or not args.get('adresse') or not args.get('arrondissement'):
+    if not args.get('userid') or not args.get('fullname') or not args.get('genre') or not args.get('dob') or not args.get('pob') or not args.get('genre') or not args.get('dob') or not args.get('pob') or not args.get('mother') or not args.get('father') or not args.get('statusm') or not args.get('conjoint') or args.get('nbenfant') is None or not args.get('contacts') or not args.get('adresse') or not args.get('arrondissement'):
         return {
             'userid': 'the account link to this member is required',
             'fullname': 'fullname is required',
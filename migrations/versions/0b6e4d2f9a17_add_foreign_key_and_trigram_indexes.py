@@ -0,0 +1,83 @@
+"""add foreign key and trigram indexes.
+
+Revision ID: 0b6e4d2f9a17
+Revises: f47b2d8c3e61
+Create Date: 2026-10-18 16:02:44.318570
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b6e4d2f9a17'
+down_revision = 'f47b2d8c3e61'
+branch_labels = None
+depends_on = None
+
+FOREIGN_KEYS = [
+    ('users', 'role_id'),
+    ('departements', 'region_id'),
+    ('arrondissements', 'departement_id'),
+    ('typeStructure_fonction', 'fonction_id'),
+    ('structures', 'typestructure_id'),
+    ('structures', 'arrondissement_id'),
+    ('structures', 'parent_id'),
+    ('membres', 'typestructure_id'),
+    ('membres', 'arrondissement_id'),
+    ('membres', 'paroisse_consecration_id'),
+    ('membres', 'media_id'),
+    ('membres', 'user_id'),
+    ('medias', 'structure_id'),
+    ('structuremembres', 'membre_id'),
+    ('structuremembres', 'fonction_id'),
+    ('programmations', 'user_id'),
+    ('programmations', 'structure_id'),
+    ('actualites', 'user_id'),
+    ('actualites', 'structure_id'),
+    ('statistiques', 'structure_id'),
+]
+
+# (table, column of the model, index name) of the ilike('%name%') searches
+NAMES = [
+    ('regions', 'region_name', 'ix_regions_region_name_trgm'),
+    ('departements', 'departement_name', 'ix_departements_departement_name_trgm'),
+    ('arrondissements', 'arrondissement_name', 'ix_arrondissements_arrondissement_name_trgm'),
+    ('fonctions', 'fonction_name', 'ix_fonctions_fonction_name_trgm'),
+    ('typestructures', 'type_structure_name', 'ix_typestructures_type_structure_name_trgm'),
+    ('structures', 'sturcture_name', 'ix_structures_sturcture_name_trgm'),
+    ('membres', 'membre_fullname', 'ix_membres_membre_fullname_trgm'),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, column in FOREIGN_KEYS:
+        columns = [c['name'] for c in inspector.get_columns(table)]
+        indexes = [index['name'] for index in inspector.get_indexes(table)]
+        name = op.f('ix_{}_{}'.format(table, column))
+        # ix_structures_parent_id exists when add_tree_paths created the column
+        if column in columns and name not in indexes:
+            op.create_index(name, table, [column], unique=False)
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column, name in NAMES:
+        columns = [c['name'] for c in inspector.get_columns(table)]
+        if column not in columns and table == 'typestructures':
+            # the initial migration spelled it type_sturcture_name
+            column = 'type_sturcture_name'
+        op.create_index(name, table, [column], unique=False, postgresql_using='gin',
+                        postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    for table, column, name in reversed(NAMES):
+        op.drop_index(name, table_name=table)
+    # pg_trgm stays installed, other database objects may use it
+    inspector = sa.inspect(op.get_bind())
+    for table, column in reversed(FOREIGN_KEYS):
+        indexes = [index['name'] for index in inspector.get_indexes(table)]
+        name = op.f('ix_{}_{}'.format(table, column))
+        # ix_structures_parent_id belongs to the migrations before this one
+        if name in indexes and (table, column) != ('structures', 'parent_id'):
+            op.drop_index(name, table_name=table)
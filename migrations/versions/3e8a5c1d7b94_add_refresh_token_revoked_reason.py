@@ -0,0 +1,29 @@
+"""add refresh token revoked reason.
+
+Revision ID: 3e8a5c1d7b94
+Revises: 7d3c9f1e5b42
+Create Date: 2026-10-18 18:05:41.217390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8a5c1d7b94'
+down_revision = '7d3c9f1e5b42'
+branch_labels = None
+depends_on = None
+
+revoked_reason = sa.Enum('ROTATED', 'LOGOUT', 'REUSE', name='refreshTokenRevokedReason')
+
+
+def upgrade():
+    revoked_reason.create(op.get_bind(), checkfirst=True)
+    # the tokens revoked before stay without a reason, their reuse no longer revokes the others
+    op.add_column('refresh_tokens', sa.Column('revoked_reason', revoked_reason, nullable=True))
+
+
+def downgrade():
+    op.drop_column('refresh_tokens', 'revoked_reason')
+    revoked_reason.drop(op.get_bind(), checkfirst=True)
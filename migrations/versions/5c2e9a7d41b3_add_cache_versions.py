@@ -0,0 +1,28 @@
+"""add cache versions.
+
+Revision ID: 5c2e9a7d41b3
+Revises: 12bba58ac69c
+Create Date: 2026-10-18 09:12:40.318202
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2e9a7d41b3'
+down_revision = '12bba58ac69c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('cache_versions')
@@ -0,0 +1,60 @@
+"""add unaccent name indexes.
+
+Revision ID: 7d3c9f1e5b42
+Revises: 0b6e4d2f9a17
+Create Date: 2026-10-18 16:47:12.905361
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3c9f1e5b42'
+down_revision = '0b6e4d2f9a17'
+branch_labels = None
+depends_on = None
+
+F_UNACCENT = """CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS
+$$ SELECT public.unaccent('public.unaccent', $1) $$
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT"""
+
+# (table, column of the model, index name), the names of add_foreign_key_and_trigram_indexes
+NAMES = [
+    ('regions', 'region_name', 'ix_regions_region_name_trgm'),
+    ('departements', 'departement_name', 'ix_departements_departement_name_trgm'),
+    ('arrondissements', 'arrondissement_name', 'ix_arrondissements_arrondissement_name_trgm'),
+    ('fonctions', 'fonction_name', 'ix_fonctions_fonction_name_trgm'),
+    ('typestructures', 'type_structure_name', 'ix_typestructures_type_structure_name_trgm'),
+    ('structures', 'sturcture_name', 'ix_structures_sturcture_name_trgm'),
+    ('membres', 'membre_fullname', 'ix_membres_membre_fullname_trgm'),
+]
+
+
+def names():
+    inspector = sa.inspect(op.get_bind())
+    for table, column, name in NAMES:
+        columns = [c['name'] for c in inspector.get_columns(table)]
+        if column not in columns and table == 'typestructures':
+            # the initial migration spelled it type_sturcture_name
+            column = 'type_sturcture_name'
+        yield table, column, name
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+    op.execute(F_UNACCENT)
+    # the searches compare the unaccented names, the indexes of the plain
+    # columns are replaced by indexes of f_unaccent(column)
+    for table, column, name in names():
+        op.drop_index(name, table_name=table)
+        op.create_index(name, table, [sa.text('f_unaccent({}) gin_trgm_ops'.format(column))],
+                        unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    for table, column, name in names():
+        op.drop_index(name, table_name=table)
+        op.create_index(name, table, [column], unique=False, postgresql_using='gin',
+                        postgresql_ops={column: 'gin_trgm_ops'})
+    op.execute('DROP FUNCTION f_unaccent(text)')
@@ -0,0 +1,50 @@
+"""add materialized paths to typestructures and structures.
+
+Revision ID: 8f1d3b6a2c90
+Revises: 5c2e9a7d41b3
+Create Date: 2026-10-18 10:05:12.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f1d3b6a2c90'
+down_revision = '5c2e9a7d41b3'
+branch_labels = None
+depends_on = None
+
+BACKFILL = """
+WITH RECURSIVE tree(id, path) AS (
+    SELECT id, '/' || id || '/' FROM {table} WHERE parent_id IS NULL
+    UNION ALL
+    SELECT child.id, tree.path || child.id || '/'
+    FROM {table} child JOIN tree ON child.parent_id = tree.id
+)
+UPDATE {table} SET path = tree.path FROM tree WHERE {table}.id = tree.id
+"""
+
+
+def upgrade():
+    columns = [column['name'] for column in sa.inspect(
+        op.get_bind()).get_columns('structures')]
+    if 'parent_id' not in columns:
+        # structures.parent_id was added to the model without a migration
+        op.add_column('structures', sa.Column(
+            'parent_id', sa.Integer(), nullable=True))
+        op.create_foreign_key(None, 'structures', 'structures', ['parent_id'], [
+                              'id'], onupdate='CASCADE', ondelete='CASCADE')
+        op.create_index(op.f('ix_structures_parent_id'),
+                        'structures', ['parent_id'], unique=False)
+    for table in ('typestructures', 'structures'):
+        op.add_column(table, sa.Column('path', sa.String(), nullable=True))
+        op.execute(BACKFILL.format(table=table))
+        op.create_index('ix_{}_path'.format(table), table, ['path'], unique=False,
+                        postgresql_ops={'path': 'text_pattern_ops'})
+
+
+def downgrade():
+    for table in ('structures', 'typestructures'):
+        op.drop_index('ix_{}_path'.format(table), table_name=table)
+        op.drop_column(table, 'path')
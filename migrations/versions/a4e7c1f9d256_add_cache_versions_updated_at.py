@@ -0,0 +1,25 @@
+"""add updated_at to cache versions.
+
+Revision ID: a4e7c1f9d256
+Revises: 8f1d3b6a2c90
+Create Date: 2026-10-18 11:02:47.116530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e7c1f9d256'
+down_revision = '8f1d3b6a2c90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cache_versions', sa.Column('updated_at', sa.DateTime(
+        timezone=True), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade():
+    op.drop_column('cache_versions', 'updated_at')
@@ -0,0 +1,29 @@
+"""add media processing status.
+
+Revision ID: d61f0b4e8a37
+Revises: c3b8e2d5f714
+Create Date: 2026-10-18 13:20:35.802144
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd61f0b4e8a37'
+down_revision = 'c3b8e2d5f714'
+branch_labels = None
+depends_on = None
+
+media_status = sa.Enum('PROCESSING', 'READY', 'FAILED', name='mediaStatus')
+
+
+def upgrade():
+    media_status.create(op.get_bind(), checkfirst=True)
+    op.add_column('medias', sa.Column('status', media_status,
+                  server_default='READY', nullable=False))
+
+
+def downgrade():
+    op.drop_column('medias', 'status')
+    media_status.drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,24 @@
+"""add media variants.
+
+Revision ID: e2a9c57b1f08
+Revises: d61f0b4e8a37
+Create Date: 2026-10-18 14:02:11.470936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9c57b1f08'
+down_revision = 'd61f0b4e8a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('medias', sa.Column('variants', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('medias', 'variants')
@@ -0,0 +1,33 @@
+"""add media content hash.
+
+Revision ID: f47b2d8c3e61
+Revises: e2a9c57b1f08
+Create Date: 2026-10-18 15:21:37.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f47b2d8c3e61'
+down_revision = 'e2a9c57b1f08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('medias', sa.Column(
+        'content_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_medias_content_hash'), 'medias',
+                    ['content_hash'], unique=False)
+    # identical uploads now share their files
+    op.drop_constraint('medias_file_name_key', 'medias', type_='unique')
+    op.drop_constraint('medias_path_name_key', 'medias', type_='unique')
+
+
+def downgrade():
+    op.create_unique_constraint('medias_path_name_key', 'medias', ['path_name'])
+    op.create_unique_constraint('medias_file_name_key', 'medias', ['file_name'])
+    op.drop_index(op.f('ix_medias_content_hash'), table_name='medias')
+    op.drop_column('medias', 'content_hash')
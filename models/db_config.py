@@ -0,0 +1,147 @@
+"""Database Engine Configuration
+
+The connection and the pool are configured from the environment, read when
+setup_db() runs so the .env file is already loaded:
+
+    DATABASE_URL            full url, otherwise built from DB_USER, DB_PASSWORD,
+                            DB_HOST (localhost), DB_PORT (5432), DB_NAME (epccam)
+    DB_POOL_SIZE            connections kept open per worker (5)
+    DB_MAX_OVERFLOW         extra connections under load, closed afterwards (10)
+    DB_POOL_TIMEOUT         seconds to wait for a connection before failing (30)
+    DB_POOL_RECYCLE         seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING        test connections on checkout, survives failovers (true)
+    DB_STATEMENT_TIMEOUT    milliseconds, 0 for no limit (0)
+    DB_APPLICATION_NAME     shown in pg_stat_activity (epccam_backend)
+    DB_NULLPOOL             no pool in the workers, for PgBouncer (false), the
+                            DB_POOL_* settings and the statement timeout are ignored
+    DATABASE_REPLICA_URLS   comma separated urls of read replicas, used by the
+                            GET requests (see models.routing)
+    DB_EXPIRE_ON_COMMIT     reload the rows from the database after a commit
+                            (false), the sessions only live for a request
+
+Each gunicorn worker has its own pool, so the connections used at most are
+workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW), to keep under max_connections.
+"""
+import os
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.pool import NullPool
+
+
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+def database_url():
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        # Heroku style urls
+        return url.replace('postgres://', 'postgresql://', 1)
+    return URL.create('postgresql', username=os.environ.get('DB_USER', 'postgres'),
+                      password=os.environ.get('DB_PASSWORD') or None,
+                      host=os.environ.get('DB_HOST', 'localhost'),
+                      port=int(os.environ.get('DB_PORT', 5432)),
+                      database=os.environ.get('DB_NAME', 'epccam')).render_as_string(hide_password=False)
+
+
+def replica_binds():
+    """SQLALCHEMY_BINDS of the read replicas, replica_0, replica_1..."""
+    urls = [url.strip() for url in os.environ.get(
+        'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    return {'replica_{}'.format(i): url.replace('postgres://', 'postgresql://', 1)
+            for i, url in enumerate(urls)}
+
+
+def engine_options(url=None):
+    """SQLALCHEMY_ENGINE_OPTIONS for the environment, url defaults to database_url()
+
+    The connection and pool settings are those of PostgreSQL (psycopg2 and a
+    QueuePool), another backend, such as a sqlite database_path given to
+    setup_db(), keeps the defaults of its dialect.
+    """
+    if make_url(url or database_url()).get_backend_name() != 'postgresql':
+        return {}
+    connect_args = {'application_name': os.environ.get(
+        'DB_APPLICATION_NAME', 'epccam_backend')}
+    engine = {'pool_pre_ping': env_flag('DB_POOL_PRE_PING', 'true'),
+              'connect_args': connect_args}
+    if env_flag('DB_NULLPOOL', 'false'):
+        # PgBouncer pools the connections, it refuses startup options such as
+        # statement_timeout (set it on the database role instead)
+        engine['poolclass'] = NullPool
+        return engine
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout:
+        connect_args['options'] = '-c statement_timeout={}'.format(
+            statement_timeout)
+    engine.update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    })
+    return engine
+
+
+def session_options():
+    """Options of the session factory for the environment"""
+    return {'expire_on_commit': env_flag('DB_EXPIRE_ON_COMMIT', 'false')}
+
+
+class PoolStats:
+    """Counts the pool events of an engine since the worker started"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.counters = {'connects': 0, 'checkouts': 0,
+                         'invalidated': 0, 'max_checked_out': 0}
+        self.checked_out = 0
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.counters['connects'] += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.counters['checkouts'] += 1
+            self.checked_out += 1
+            self.counters['max_checked_out'] = max(
+                self.counters['max_checked_out'], self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.counters['invalidated'] += 1
+
+    def json(self):
+        pool = self.engine.pool
+        data = {'pool': type(pool).__name__, 'checked_out': self.checked_out}
+        if hasattr(pool, 'size'):
+            data.update({'size': pool.size(), 'checked_in': pool.checkedin(),
+                         'overflow': pool.overflow(), 'timeout': pool.timeout()})
+        with self.lock:
+            data.update(self.counters)
+        return data
+
+
+# PoolStats by bind key, None for the default engine
+pool_stats = {}
+
+
+def watch_pools(engines):
+    for key, engine in engines.items():
+        if key not in pool_stats:
+            pool_stats[key] = PoolStats(engine)
+
+
+def pool_metrics():
+    return {key or 'default': stats.json() for key, stats in pool_stats.items()}
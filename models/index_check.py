@@ -0,0 +1,46 @@
+"""Unindexed Foreign Keys
+
+Postgres doesn't index the referencing side of a foreign key: without an
+index, the joins from the parent, the lookups of its children and every
+ON DELETE check scan the whole table. `flask check-indexes` lists the
+foreign keys whose columns don't start an index, the primary key or a
+unique constraint, in the models and, with --database, in the database.
+"""
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint, inspect
+
+
+def missing(tables):
+    """tables: [(name, [indexed column tuples], [foreign key column tuples])]"""
+    found = []
+    for name, indexed, foreign_keys in tables:
+        for columns in foreign_keys:
+            if not any(tuple(index[:len(columns)]) == tuple(columns) for index in indexed):
+                found.append((name, tuple(columns)))
+    return found
+
+
+def unindexed_foreign_keys(metadata):
+    """[(table, columns)] of the foreign keys of the models without an index"""
+    tables = []
+    for table in metadata.sorted_tables:
+        indexed = [[column.name for column in index.columns] for index in table.indexes]
+        indexed += [[column.name for column in constraint.columns] for constraint in table.constraints
+                    if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint))]
+        indexed += [[column.name] for column in table.columns if column.unique]
+        tables.append((table.name, indexed, [[column.name for column in constraint.columns]
+                                             for constraint in table.foreign_key_constraints]))
+    return missing(tables)
+
+
+def unindexed_foreign_keys_in_database(engine):
+    """The same check on the tables of a live database"""
+    inspector = inspect(engine)
+    tables = []
+    for name in inspector.get_table_names():
+        indexed = [index['column_names'] for index in inspector.get_indexes(name)]
+        indexed.append(inspector.get_pk_constraint(name)['constrained_columns'])
+        indexed += [constraint['column_names']
+                    for constraint in inspector.get_unique_constraints(name)]
+        tables.append((name, indexed, [key['constrained_columns']
+                                       for key in inspector.get_foreign_keys(name)]))
+    return missing(tables)
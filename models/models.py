@@ -1,26 +1,165 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import hashlib
+import logging
+import os
+import secrets
 from time import timezone
-from sqlalchemy import Column, String, Integer, Boolean, Text, func
+from itertools import chain
+from sqlalchemy import DDL, Column, String, Integer, Boolean, Text, event, func, inspect, literal, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from flask import current_app, has_request_context, request, url_for
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import check_password_hash
+from .db_config import database_url, engine_options, replica_binds, session_options, watch_pools
+from .routing import RoutingSession
+from .serializers import Schema, iso, many, method, nested
 
-database_name = "epccam"
-database_path = "postgresql://postgres:OPBco@{}/{}".format(
-    'localhost:5432', database_name)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+ACCESS_TOKEN_LIFETIME = timedelta(
+    minutes=int(os.environ.get('ACCESS_TOKEN_MINUTES', 30)))
+REFRESH_TOKEN_LIFETIME = timedelta(
+    days=int(os.environ.get('REFRESH_TOKEN_DAYS', 30)))
+
+# unaccent() is only STABLE, its dictionary could change, so it can't be used
+# in an index; the wrapper pins the dictionary and is declared IMMUTABLE
+F_UNACCENT = """CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS
+$$ SELECT public.unaccent('public.unaccent', $1) $$
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT"""
+
+
+def trigram_index(table, column):
+    """GIN index of the accent insensitive searches of a name column, see flaskr.search"""
+    return db.Index('ix_{}_{}_trgm'.format(table, column),
+                    text('f_unaccent({}) gin_trgm_ops'.format(column)), postgresql_using='gin')
+
+
+# the create_all of a new database, the migrations create them for the others
+for statement in ('CREATE EXTENSION IF NOT EXISTS pg_trgm', 'CREATE EXTENSION IF NOT EXISTS unaccent', F_UNACCENT):
+    event.listen(db.metadata, 'before_create', DDL(statement))
+
+
+# how many levels of TypeStructure.parent are joined eagerly, deeper levels
+# are lazy loaded (synod -> presbytery -> parish only needs 3)
+TYPESTRUCTURE_DEPTH = 4
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, the database and the
+    pool are configured from the environment (see models.db_config)
 '''
 
 
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path or database_url()
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_BINDS"] = replica_binds()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.session.session_factory.configure(**session_options())
     db.app = app
     db.init_app(app)
+    with app.app_context():
+        watch_pools(db.engines)
+
+
+'''
+Unit of work
+    inside unit_of_work() (flaskr.transaction.transactional runs the write
+    handlers in one) the insert()/update()/delete() methods only flush, the
+    transaction is committed once when the outermost unit of work ends, or
+    rolled back as a whole
+'''
+
+
+def commit():
+    """Commits the session, or only flushes it inside a unit of work"""
+    if db.session.info.get('uow_depth'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def after_commit(callback):
+    """Calls callback once the unit of work is committed (at once outside of one), for work other sessions must see"""
+    if db.session.info.get('uow_depth'):
+        db.session.info.setdefault('uow_callbacks', []).append(callback)
+    else:
+        run_callback(callback)
+
+
+def run_callback(callback):
+    # the write is committed whatever happens here, a failure must not turn it into an error response
+    try:
+        callback()
+    except Exception:
+        logger.exception('after commit callback %r failed', callback)
+
+
+@contextmanager
+def unit_of_work():
+    session = db.session
+    info = session.info
+    outermost = not info.get('uow_depth')
+    info['uow_depth'] = info.get('uow_depth', 0) + 1
+    try:
+        yield session
+        if outermost:
+            session.commit()
+    except BaseException:
+        if outermost:
+            session.rollback()
+            info.pop('uow_callbacks', None)
+        raise
+    finally:
+        info['uow_depth'] -= 1
+    if outermost:
+        for callback in info.pop('uow_callbacks', []):
+            run_callback(callback)
+
+
+'''
+Written columns
+    the column attributes each flush writes are kept per row until the
+    transaction ends, every column for the inserted rows, so the write
+    endpoints can answer with only what they changed (flaskr.representation)
+'''
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_written_columns(session, flush_context, instances):
+    written = session.info.setdefault('written_columns', {})
+    for instance in chain(session.new, session.dirty):
+        state = inspect(instance)
+        mapper = state.mapper
+        if instance in session.new:
+            columns = {attribute.key for attribute in mapper.column_attrs}
+        else:
+            columns = {attribute.key for attribute in mapper.column_attrs
+                       if state.attrs[attribute.key].history.has_changes()}
+            # a many to one relationship set to a row writes its foreign key
+            for relationship in mapper.relationships:
+                if not relationship.uselist and state.attrs[relationship.key].history.has_changes():
+                    columns.update(mapper.get_property_by_column(column).key
+                                   for column in relationship.local_columns
+                                   if column.table is mapper.local_table)
+        if columns:
+            written.setdefault(instance, set()).update(columns)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def forget_written_columns(session):
+    session.info.pop('written_columns', None)
+
+
+def written_columns(row):
+    """The column attributes of row written in the current transaction"""
+    return db.session.info.get('written_columns', {}).get(row, set())
 
 
 '''
@@ -35,7 +174,7 @@ class User(db.Model):
     user_name = Column(String, unique=True, nullable=False)
     email = Column(String, unique=True, nullable=False)
     password = Column(String, nullable=False)
-    role_id = Column(Integer, db.ForeignKey('roles.id'), nullable=False)
+    role_id = Column(Integer, db.ForeignKey('roles.id'), nullable=False, index=True)
     active = Column(Boolean, nullable=False, default=True)
     membre = db.relationship('Membre', backref='user', lazy=True)
     programmations = db.relationship(
@@ -43,10 +182,10 @@ class User(db.Model):
     actualites = db.relationship(
         'Actualite', backref='user', lazy=True)
 
-    """Get a active user by email"""
+    """Get a active user by email, with its role"""
     @staticmethod
     def get_by_email(email):
-        return User.query.filter(User.email == email, User.active == True).one_or_none()
+        return User.query.options(joinedload(User.role)).filter(User.email == email, User.active == True).one_or_none()
 
     """Login a user"""
     @staticmethod
@@ -54,26 +193,108 @@ class User(db.Model):
         user = User.get_by_email(email)
         if user is None or not check_password_hash(user.password, password):
             return
-        return {'exp': datetime.utcnow() + timedelta(minutes=30), 'userid': user.id, 'username': user.user_name, 'email': user.email, 'role_name': user.role.role_name, 'permissions': user.role.permissions}
+        return user.claims()
+
+    def claims(self):
+        """The payload of a new access token"""
+        return {'exp': datetime.utcnow() + ACCESS_TOKEN_LIFETIME, 'userid': self.id, 'username': self.user_name, 'email': self.email, 'role_name': self.role.role_name, 'permissions': self.role.permissions}
 
     def short_repr(self):
         return {'userid': self.id, 'username': self.user_name, 'email': self.email, 'role_name': self.role.role_name, 'permissions': self.role.permissions}
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<User ID: {self.id} UserName: {self.user_name} Email: {self.email} >'
 
 
+'''
+RefreshToken
+a long lived token exchanged for new access tokens without the password.
+Only its sha256 is stored, it is rotated on every use and presenting a
+rotated (revoked) token again revokes every token of the user.
+'''
+
+
+class RefreshToken(db.Model):
+    __tablename__ = 'refresh_tokens'
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), unique=True, nullable=False)
+    user_id = Column(Integer, db.ForeignKey(
+        'users.id', ondelete="CASCADE"), nullable=False, index=True)
+    expires_at = Column(db.DateTime, nullable=False)
+    revoked = Column(Boolean, nullable=False, default=False)
+    # ROTATED by a refresh, LOGOUT, or REUSE when the reuse of a rotated token revoked them all
+    revoked_reason = Column(db.Enum('ROTATED', 'LOGOUT', 'REUSE', name='refreshTokenRevokedReason'),
+                            nullable=True)
+    date_created = Column(db.DateTime(timezone=True),
+                          server_default=func.now())
+    user = db.relationship('User', lazy=True)
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    """Create a token for a user, returns the token itself (not stored)"""
+    @staticmethod
+    def issue(user_id):
+        RefreshToken.query.filter(RefreshToken.user_id == user_id, RefreshToken.expires_at < datetime.utcnow()).delete(
+            synchronize_session=False)
+        token = secrets.token_urlsafe(32)
+        db.session.add(RefreshToken(token_hash=RefreshToken.hash(token), user_id=user_id,
+                                    expires_at=datetime.utcnow() + REFRESH_TOKEN_LIFETIME))
+        return token
+
+    """Find a token with its user and role in one query"""
+    @staticmethod
+    def getByToken(token):
+        return RefreshToken.query.options(joinedload(RefreshToken.user).joinedload(User.role)).filter(
+            RefreshToken.token_hash == RefreshToken.hash(token)).one_or_none()
+
+    """Revoke the token unless it already is, True for the request that did it
+
+    A single UPDATE ... WHERE NOT revoked: of two refreshes with the same
+    token the second waits for the row lock of the first and updates nothing.
+    """
+    def revoke(self, reason):
+        return RefreshToken.query.filter(RefreshToken.id == self.id, RefreshToken.revoked.is_(False)).update(
+            {'revoked': True, 'revoked_reason': reason}) == 1
+
+    """Revoke the token for its rotation, True for the refresh that did it"""
+    def claim(self):
+        return self.revoke('ROTATED')
+
+    """True when a refresh rotated the token, using it again means it leaked
+
+    Read from the database, a concurrent refresh or logout may have revoked it
+    since the token was loaded.
+    """
+    def wasRotated(self):
+        return db.session.query(RefreshToken.revoked_reason).filter(
+            RefreshToken.id == self.id).scalar() == 'ROTATED'
+
+    """Revoke every token of a user, the ones already revoked keep their reason"""
+    @staticmethod
+    def revokeAll(user_id):
+        RefreshToken.query.filter(RefreshToken.user_id == user_id, RefreshToken.revoked.is_(False)).update(
+            {'revoked': True, 'revoked_reason': 'REUSE'}, synchronize_session=False)
+
+    def isValid(self):
+        return not self.revoked and self.expires_at > datetime.utcnow() and self.user.active
+
+    def __repr__(self):
+        return f'<RefreshToken ID: {self.id} User: {self.user_id} Revoked: {self.revoked} >'
+
+
 class Role(db.Model):
     __tablename__ = 'roles'
     id = Column(Integer, primary_key=True)
@@ -84,14 +305,14 @@ class Role(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Role ID: {self.id} RoleName: {self.role_name} >'
@@ -102,20 +323,23 @@ class Region(db.Model):
     id = Column(Integer, primary_key=True)
     region_name = Column(String, unique=True, nullable=False)
     departements = db.relationship('Departement', backref='region', lazy=True)
+    __table_args__ = (trigram_index('regions', 'region_name'),)
+
+    jsonSchema = Schema({'id': 'id', 'name': 'region_name'})
 
     def json(self):
-        return {'id': self.id, 'name': self.region_name}
+        return Region.jsonSchema(self)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Region ID: {self.id} Name: {self.region_name} >'
@@ -124,24 +348,33 @@ class Region(db.Model):
 class Departement(db.Model):
     __tablename__ = 'departements'
     id = Column(Integer, primary_key=True)
-    region_id = Column(Integer, db.ForeignKey('regions.id'), nullable=False)
+    region_id = Column(Integer, db.ForeignKey('regions.id'), nullable=False, index=True)
     departement_name = Column(String, unique=True, nullable=False)
     arrondissements = db.relationship(
         'Arrondissement', backref='departement', lazy=True)
+    __table_args__ = (trigram_index('departements', 'departement_name'),)
+
+    jsonSchema = Schema({'id': 'id', 'name': 'departement_name',
+                         'region': nested('region', Region.jsonSchema, 'region_id')})
 
     def json(self):
-        return {'id': self.id, 'name': self.departement_name, 'region': self.region.json()}
+        return Departement.jsonSchema(self)
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json()"""
+        return [joinedload(Departement.region)]
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Departement ID: {self.id} Name: {self.departement_name} >'
@@ -151,24 +384,35 @@ class Arrondissement(db.Model):
     __tablename__ = 'arrondissements'
     id = Column(Integer, primary_key=True)
     departement_id = Column(Integer, db.ForeignKey(
-        'departements.id'), nullable=False)
+        'departements.id'), nullable=False, index=True)
     arrondissement_name = Column(String, nullable=False)
     structures = db.relationship(
         'Structure', backref='arrondissement', lazy=True)
+    membres = db.relationship(
+        'Membre', backref='arrondissement', lazy=True)
+    __table_args__ = (trigram_index('arrondissements', 'arrondissement_name'),)
+
+    jsonSchema = Schema({'id': 'id', 'name': 'arrondissement_name',
+                         'departement': nested('departement', Departement.jsonSchema, 'departement_id')})
 
     def json(self):
-        return {'id': self.id, 'name': self.arrondissement_name, 'departement': self.departement.json()}
+        return Arrondissement.jsonSchema(self)
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json()"""
+        return [joinedload(Arrondissement.departement).options(*Departement.jsonOptions())]
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     @classmethod
     def getByID(cls, _id):
@@ -186,20 +430,23 @@ class Fonction(db.Model):
     typestructures = db.relationship(
         "TypeStructure_fonction", back_populates="fonction")
     membres = db.relationship("StructureMembre", backref="fonction")
+    __table_args__ = (trigram_index('fonctions', 'fonction_name'),)
+
+    jsonSchema = Schema({'id': 'id', 'name': 'fonction_name'})
 
     def json(self):
-        return {'id': self.id, 'name': self.fonction_name}
+        return Fonction.jsonSchema(self)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     @classmethod
     def getByID(cls, _id):
@@ -216,17 +463,30 @@ class TypeStructure(db.Model):
     type_structure_name = Column(String, unique=True, nullable=False)
     parent_id = Column(Integer, db.ForeignKey(
         'typestructures.id', onupdate="CASCADE", ondelete="CASCADE"), index=True)
+    # materialized path of ids from the root, maintained by tree_path_events
+    path = Column(String, nullable=True)
     sub_typeStructure = db.relationship(
         "TypeStructure", backref=db.backref("parent", remote_side=[id]))
     fonctions = db.relationship(
         "TypeStructure_fonction", back_populates="typestructure")
     structures = db.relationship(
         'Structure', backref='typestructure', lazy=True)
+    __table_args__ = (db.Index('ix_typestructures_path', path,
+                               postgresql_ops={'path': 'text_pattern_ops'}),
+                      trigram_index('typestructures', 'type_structure_name'))
+
+    jsonSchema = Schema({'id': 'id', 'name': 'type_structure_name',
+                         'parent': nested('parent', 'json', 'parent_id')})
 
     def json(self):
-        if not self.parent_id:
-            return {'id': self.id, 'name': self.type_structure_name, 'parent': None}
-        return {'id': self.id, 'name': self.type_structure_name, 'parent': self.parent.json()}
+        return TypeStructure.jsonSchema(self)
+
+    @staticmethod
+    def jsonOptions(depth=TYPESTRUCTURE_DEPTH):
+        """loader options needed by json(), the parent chain is joined depth levels deep"""
+        if depth <= 0:
+            return []
+        return [joinedload(TypeStructure.parent).options(*TypeStructure.jsonOptions(depth - 1))]
 
     def withFonctions(self):
         fonctionsJson = []
@@ -236,6 +496,19 @@ class TypeStructure(db.Model):
             return {'id': self.id, 'name': self.type_structure_name, 'parent': None, 'fonctions': fonctionsJson}
         return {'id': self.id, 'name': self.type_structure_name, 'parent': self.parent.json(), 'fonctions': fonctionsJson}
 
+    @staticmethod
+    def withFonctionsOptions():
+        """loader options needed by withFonctions()"""
+        return TypeStructure.jsonOptions() + [selectinload(TypeStructure.fonctions).joinedload(TypeStructure_fonction.fonction)]
+
+    def ancestors(self, *options):
+        """the parent chain from the root down, in one query"""
+        return ancestors_of(TypeStructure, self, *options)
+
+    def descendants(self, *options):
+        """query of the whole subtree under this type"""
+        return descendants_of(TypeStructure, self, *options)
+
     @classmethod
     def getByID(cls, _id):
         find = cls.query.filter_by(id=_id).one_or_none()
@@ -243,14 +516,14 @@ class TypeStructure(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<TypeStructure ID: {self.id} Name: {self.type_structure_name} >'
@@ -261,31 +534,44 @@ class TypeStructure_fonction(db.Model):
     typestructure_id = Column(Integer, db.ForeignKey(
         'typestructures.id'), primary_key=True)
     fonction_id = Column(Integer, db.ForeignKey(
-        'fonctions.id'), primary_key=True)
+        'fonctions.id'), primary_key=True, index=True)
     nombre_position = Column(Integer, nullable=False)
     typestructure = db.relationship(
         "TypeStructure", back_populates="fonctions")
     fonction = db.relationship("Fonction", back_populates="typestructures")
 
+    jsonSchema = Schema({'typestructure': nested('typestructure', TypeStructure.jsonSchema, 'typestructure_id'),
+                         'fonction': nested('fonction', Fonction.jsonSchema, 'fonction_id'), 'nombre': 'nombre_position'})
+    forTypeStructureSchema = Schema({'fonction': nested('fonction', Fonction.jsonSchema, 'fonction_id'),
+                                     'nombre': 'nombre_position'})
+    forTypeFonctionSchema = Schema({'typestructure': nested('typestructure', TypeStructure.jsonSchema, 'typestructure_id'),
+                                    'nombre': 'nombre_position'})
+
     def json(self):
-        return {'typestructure': self.typestructure.json(), 'fonction': self.fonction.json(), 'nombre': self.nombre_position}
+        return TypeStructure_fonction.jsonSchema(self)
 
     def jsonForTypeStructure(self):
-        return {'fonction': self.fonction.json(), 'nombre': self.nombre_position}
+        return TypeStructure_fonction.forTypeStructureSchema(self)
 
     def jsonForTypeFonction(self):
-        return {'typestructure': self.typestructure.json(), 'nombre': self.nombre_position}
+        return TypeStructure_fonction.forTypeFonctionSchema(self)
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json()"""
+        return [joinedload(TypeStructure_fonction.fonction),
+                joinedload(TypeStructure_fonction.typestructure).options(*TypeStructure.jsonOptions())]
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
 
 class Structure(db.Model):
@@ -299,9 +585,9 @@ class Structure(db.Model):
     date_creation = Column(db.DateTime(timezone=True),
                            server_default=func.now())
     typestructure_id = Column(Integer, db.ForeignKey(
-        'typestructures.id'), nullable=False)
+        'typestructures.id'), nullable=False, index=True)
     arrondissement_id = Column(Integer, db.ForeignKey(
-        'arrondissements.id'), nullable=False)
+        'arrondissements.id'), nullable=False, index=True)
     statistiques = db.relationship(
         'Statistique', backref='structure', lazy=True)
     consacrete_membres = db.relationship(
@@ -313,32 +599,66 @@ class Structure(db.Model):
         "Programmation", backref='structure', lazy=True)
     parent_id = Column(Integer, db.ForeignKey(
         'structures.id', onupdate="CASCADE", ondelete="CASCADE"), index=True)
+    # materialized path of ids from the root, maintained by tree_path_events
+    path = Column(String, nullable=True)
     sub_structures = db.relationship(
         "Structure", backref=db.backref("parent", remote_side=[id]))
+    __table_args__ = (db.Index('ix_structures_path', path,
+                               postgresql_ops={'path': 'text_pattern_ops'}),
+                      trigram_index('structures', 'sturcture_name'))
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
+
+    shortJsonSchema = Schema({'id': 'id', 'name': 'sturcture_name', 'adresse': 'structure_adresse',
+                              'contacts': 'structure_contacts'})
+    detailsSchema = shortJsonSchema.extend({
+        'nombre_communicant': 'nombre_communicant', 'nombre_baptise': 'nombre_baptise',
+        'type': nested('typestructure', TypeStructure.jsonSchema, 'typestructure_id'),
+        'arrondissement': nested('arrondissement', Arrondissement.jsonSchema, 'arrondissement_id')})
+    jsonSchema = detailsSchema.extend({'medias': many('medias', 'json')})
+    jsonWithParentSchema = detailsSchema.extend({'parent': nested('parent', 'shortJson', 'parent_id')})
 
     def shortJson(self):
+        data = Structure.shortJsonSchema(self)
         if self.parent_id:
-            return {'id': self.id, 'name': self.sturcture_name, 'adresse': self.structure_adresse, 'contacts': self.structure_contacts, 'parent': self.parent.json()}
-        return {'id': self.id, 'name': self.sturcture_name, 'adresse': self.structure_adresse, 'contacts': self.structure_contacts}
+            data['parent'] = self.parent.json()
+        return data
+
+    @staticmethod
+    def shortJsonOptions():
+        """loader options needed by shortJson()"""
+        return [selectinload(Structure.parent).options(*Structure.jsonOptions())]
 
     def jsonWithParent(self):
-        if self.parent_id:
-            return {'parent': self.parent.shortJson(), 'id': self.id, 'name': self.sturcture_name, 'adresse': self.structure_adresse, 'contacts': self.structure_contacts, 'nombre_communicant': self.nombre_communicant, 'nombre_baptise': self.nombre_baptise, 'type': self.typestructure.json(), 'arrondissement': self.arrondissement.json()}
-        return {'id': self.id, 'name': self.sturcture_name, 'adresse': self.structure_adresse, 'contacts': self.structure_contacts, 'nombre_communicant': self.nombre_communicant, 'nombre_baptise': self.nombre_baptise, 'type': self.typestructure.json(), 'arrondissement': self.arrondissement.json()}
+        return Structure.jsonWithParentSchema(self)
+
+    @staticmethod
+    def jsonWithParentOptions():
+        """loader options needed by jsonWithParent()"""
+        return [selectinload(Structure.parent).options(*Structure.shortJsonOptions()),
+                joinedload(Structure.typestructure).options(
+                    *TypeStructure.jsonOptions()),
+                joinedload(Structure.arrondissement).options(*Arrondissement.jsonOptions())]
 
     def json(self):
-        return {'id': self.id, 'name': self.sturcture_name, 'adresse': self.structure_adresse, 'contacts': self.structure_contacts, 'nombre_communicant': self.nombre_communicant, 'nombre_baptise': self.nombre_baptise, 'type': self.typestructure.json(), 'arrondissement': self.arrondissement.json(), 'medias': self.mediasJson()}
+        return Structure.jsonSchema(self)
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json()"""
+        return [joinedload(Structure.typestructure).options(*TypeStructure.jsonOptions()),
+                joinedload(Structure.arrondissement).options(
+                    *Arrondissement.jsonOptions()),
+                selectinload(Structure.medias)]
 
     def subStructureJson(self):
         data = []
@@ -346,12 +666,25 @@ class Structure(db.Model):
             data.append(structure.json())
         return data
 
+    @staticmethod
+    def subStructureJsonOptions():
+        """loader options needed by subStructureJson()"""
+        return [selectinload(Structure.sub_structures).options(*Structure.jsonOptions())]
+
     def mediasJson(self):
         data = []
         for media in self.medias:
             data.append(media.json())
         return data
 
+    def ancestors(self, *options):
+        """the parent chain from the root down, in one query"""
+        return ancestors_of(Structure, self, *options)
+
+    def descendants(self, *options):
+        """query of the whole subtree under this structure"""
+        return descendants_of(Structure, self, *options)
+
     @classmethod
     def getByID(cls, structure_id):
         structure = cls.query.filter_by(id=structure_id).one_or_none()
@@ -366,6 +699,104 @@ class Structure(db.Model):
         return f'<TypeStructure ID: {self.id} Name: {self.sturcture_name} >'
 
 
+'''
+Materialized paths
+    TypeStructure.path and Structure.path hold the ids from the root down to
+    the row, e.g. '/1/4/17/', so a subtree is one LIKE '/1/4/17/%' and the
+    ancestors are one IN on the ids of the path. They are kept up to date by
+    the mapper events below on insert, on parent change and when deleting a
+    parent detaches its children. A row without a path yet (not backfilled)
+    is handled by walking the parent_id chain instead.
+'''
+
+# deeper parent_id chains are taken for cycles
+TREE_MAX_DEPTH = 100
+
+
+def path_ids(path):
+    return [int(_id) for _id in path.strip('/').split('/')] if path else []
+
+
+def ancestors_of(model, node, *options):
+    ids = path_ids(node.path)[:-1]
+    if not ids:
+        return []
+    rows = {row.id: row for row in model.query.options(
+        *options).filter(model.id.in_(ids)).all()}
+    return [rows[_id] for _id in ids if _id in rows]
+
+
+def descendants_of(model, node, *options):
+    if node.path is None:
+        # UNION, not UNION ALL, stops on a cycle
+        tree = select(model.id).where(model.parent_id == node.id).cte(recursive=True)
+        tree = tree.union(select(model.id).where(model.parent_id == tree.c.id))
+        return model.query.options(*options).filter(model.id.in_(select(tree.c.id)), model.id != node.id)
+    return model.query.options(*options).filter(model.path.like(node.path + '%'), model.id != node.id)
+
+
+def path_from_parents(connection, table, node_id):
+    """The path of a row built from its parent_id chain, for the rows without one"""
+    chain = select(table.c.id, table.c.parent_id, literal(0).label('depth')).where(
+        table.c.id == node_id).cte(recursive=True)
+    chain = chain.union_all(select(table.c.id, table.c.parent_id, chain.c.depth + 1).where(
+        table.c.id == chain.c.parent_id, chain.c.depth < TREE_MAX_DEPTH))
+    rows = connection.execute(select(chain.c.id, chain.c.parent_id).order_by(chain.c.depth.desc())).all()
+    if not rows or rows[0].parent_id is not None:
+        raise ValueError('{} {} has no root, its parent chain is broken or has a cycle'.format(
+            table.name, node_id))
+    return '/' + ''.join('{}/'.format(row.id) for row in rows)
+
+
+def tree_path_events(model):
+    table = model.__table__
+
+    def build_path(connection, target):
+        if target.parent_id is None:
+            return '/{}/'.format(target.id)
+        parent_path = connection.scalar(
+            select(table.c.path).where(table.c.id == target.parent_id))
+        if parent_path is None:
+            parent_path = path_from_parents(connection, table, target.parent_id)
+        return '{}{}/'.format(parent_path, target.id)
+
+    @event.listens_for(model, 'after_insert')
+    def set_path(mapper, connection, target):
+        path = build_path(connection, target)
+        connection.execute(table.update().where(
+            table.c.id == target.id).values(path=path))
+        set_committed_value(target, 'path', path)
+
+    @event.listens_for(model, 'before_update')
+    def check_cycle(mapper, connection, target):
+        if not get_history(target, 'parent_id').has_changes() or target.parent_id is None:
+            return
+        parent_path = connection.scalar(
+            select(table.c.path).where(table.c.id == target.parent_id))
+        if target.parent_id == target.id or '/{}/'.format(target.id) in (parent_path or ''):
+            raise ValueError('{} {} cannot be moved under its own subtree'.format(
+                model.__name__, target.id))
+
+    @event.listens_for(model, 'after_update')
+    def move_subtree(mapper, connection, target):
+        if not get_history(target, 'parent_id').has_changes():
+            return
+        old_path = connection.scalar(
+            select(table.c.path).where(table.c.id == target.id))
+        path = build_path(connection, target)
+        if old_path:
+            connection.execute(table.update().where(table.c.path.like(old_path + '%')).values(
+                path=func.concat(path, func.substr(table.c.path, len(old_path) + 1))))
+        else:
+            connection.execute(table.update().where(
+                table.c.id == target.id).values(path=path))
+        set_committed_value(target, 'path', path)
+
+
+tree_path_events(TypeStructure)
+tree_path_events(Structure)
+
+
 class Membre(db.Model):
     __tablename__ = 'membres'
     id = Column(Integer, primary_key=True)
@@ -388,25 +819,26 @@ class Membre(db.Model):
     date_updated = Column(db.DateTime(timezone=True),
                           onupdate=func.now())
     typestructure_id = Column(Integer, db.ForeignKey(
-        'typestructures.id'), nullable=True)
+        'typestructures.id'), nullable=True, index=True)
     arrondissement_id = Column(Integer, db.ForeignKey(
-        'arrondissements.id'), nullable=False)
+        'arrondissements.id'), nullable=False, index=True)
     paroisse_consecration_id = Column(
-        Integer, db.ForeignKey('structures.id'), nullable=True)
-    media_id = Column(Integer, db.ForeignKey('medias.id'), nullable=True)
-    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
+        Integer, db.ForeignKey('structures.id'), nullable=True, index=True)
+    media_id = Column(Integer, db.ForeignKey('medias.id'), nullable=True, index=True)
+    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     structures = db.relationship("StructureMembre", back_populates="membre")
+    __table_args__ = (trigram_index('membres', 'membre_fullname'),)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     @classmethod
     def getByID(cls, membre_id):
@@ -419,32 +851,56 @@ class Membre(db.Model):
         return membre
 
     def myStructures(self):
-        structures = db.session.query(StructureMembre).join(
-            Membre, StructureMembre.membre_id == Membre.id).order_by(db.desc(StructureMembre.date_affectation), StructureMembre.actuel).all()
-        data = [structuremembre.structure.json()
+        structures = StructureMembre.query.options(*StructureMembre.jsonOptions()).filter(
+            StructureMembre.membre_id == self.id).order_by(db.desc(StructureMembre.date_affectation), StructureMembre.actuel).all()
+        data = [structuremembre.json()
                 for structuremembre in structures]
         return data
 
-    def json(self):
-        return {
-            'id': self.id,
-            'fullname': self.membre_fullname,
-            'genre': self.membre_genre,
-            'dob': self.membre_dob,
-            'pob': self.membre_pob,
-            'mother': self.membre_mother,
-            'father': self.membre_father,
-            'statusm': self.status_matrimonial,
-            'conjoint': self.membre_conjoint,
-            'nbenfant': self.membre_nbenfant,
-            'contacts': self.membre_contacts,
-            'adresse': self.membre_adresse,
-            'arrondissement': self.arrondissement.json(),
-            'date_consecration': self.date_consecration,
-            'consecratoire': self.paroisse_consacrete.json(),
-            'avatar': self.avatar.json(),
-            'structures': self.myStructures()
-        }
+    @staticmethod
+    def structuresByMembre(membre_ids):
+        """myStructures() for many membres at once, returns {membre_id: [structures]}"""
+        data = {membre_id: [] for membre_id in membre_ids}
+        if not data:
+            return data
+        structures = StructureMembre.query.options(*StructureMembre.jsonOptions()).filter(
+            StructureMembre.membre_id.in_(data.keys())).order_by(db.desc(StructureMembre.date_affectation), StructureMembre.actuel).all()
+        for structuremembre in structures:
+            data[structuremembre.membre_id].append(structuremembre.json())
+        return data
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json(), structures are fetched by myStructures()"""
+        return [joinedload(Membre.arrondissement).options(*Arrondissement.jsonOptions()),
+                joinedload(Membre.paroisse_consacrete).options(
+                    *Structure.jsonOptions()),
+                joinedload(Membre.avatar)]
+
+    jsonSchema = Schema({
+        'id': 'id',
+        'fullname': 'membre_fullname',
+        'genre': 'membre_genre',
+        'dob': iso('membre_dob'),
+        'pob': 'membre_pob',
+        'mother': 'membre_mother',
+        'father': 'membre_father',
+        'statusm': 'status_matrimonial',
+        'conjoint': 'membre_conjoint',
+        'nbenfant': 'membre_nbenfant',
+        'contacts': 'membre_contacts',
+        'adresse': 'membre_adresse',
+        'arrondissement': nested('arrondissement', Arrondissement.jsonSchema, 'arrondissement_id'),
+        'date_consecration': iso('date_consecration'),
+        'consecratoire': nested('paroisse_consacrete', Structure.jsonSchema, 'paroisse_consecration_id'),
+        'avatar': nested('avatar', 'json', 'media_id'),
+    })
+
+    def json(self, structures=None):
+        """structures can be given when they were fetched with structuresByMembre()"""
+        data = Membre.jsonSchema(self)
+        data['structures'] = self.myStructures() if structures is None else structures
+        return data
 
     def __repr__(self):
         return f'<Membre ID: {self.id} Name: {self.membre_fullname} >'
@@ -453,31 +909,83 @@ class Membre(db.Model):
 class Media(db.Model):
     __tablename__ = 'medias'
     id = Column(Integer, primary_key=True)
-    file_name = Column(String, unique=True, nullable=False)
-    path_name = Column(String, unique=True, nullable=False)
+    # <sha256><ext> in the media store, shared by the uploads of the same file
+    file_name = Column(String, nullable=False)
+    # the stored file shown as file_url (the smallest variant for avatars), the
+    # absolute url for the medias saved before the media store
+    path_name = Column(String, nullable=False)
+    content_hash = Column(String(64), nullable=True, index=True)
     type_media = Column(db.Enum('IMAGE', 'VIDEO', 'DOC', name='mediaTypes'),
                         nullable=False, server_default='IMAGE')
     date_created = Column(db.DateTime(timezone=True),
                           server_default=func.now())
     date_updated = Column(db.DateTime(timezone=True),
                           onupdate=func.now())
+    # PROCESSING until flaskr.save_image.process_pic has resized the upload
+    status = Column(db.Enum('PROCESSING', 'READY', 'FAILED', name='mediaStatus'),
+                    nullable=False, server_default='READY')
+    # {size name: {'width', 'height', 'jpeg': file name, 'webp': file name}}
+    variants = Column(db.JSON, nullable=True)
     avatar_membre = db.relationship('Membre', backref='avatar', lazy=True)
     structure_id = Column(Integer, db.ForeignKey(
-        'structures.id'), nullable=True)
+        'structures.id'), nullable=True, index=True)
+    # date_created comes back with the INSERT (RETURNING), the upload
+    # responses show it without reloading the row
+    __mapper_args__ = {'eager_defaults': True}
+
+    jsonSchema = Schema({'id': 'id', 'file_name': 'file_name', 'file_url': method('fileUrl', ('content_hash', 'path_name')),
+                         'type': 'type_media', 'status': 'status', 'created_on': iso('date_created'),
+                         'variants': method('variantsJson', ('content_hash', 'path_name', 'variants')),
+                         'srcset': method('srcset', ('content_hash', 'path_name', 'variants'))})
 
     def json(self):
-        return {'id': self.id, 'file_name': self.file_name, 'file_url': self.path_name, 'type': self.type_media, 'created_on': self.date_created}
+        return Media.jsonSchema(self)
+
+    def fileUrl(self):
+        if self.content_hash is None:
+            return self.path_name
+        return self.variantUrl(self.path_name)
+
+    def variantUrl(self, file_name):
+        if self.content_hash is None:
+            return self.path_name.rsplit('/', 1)[0] + '/' + file_name
+        base_url = current_app.config.get('MEDIA_BASE_URL')
+        if base_url:
+            return base_url + file_name
+        if has_request_context():
+            return request.host_url + 'media/' + file_name
+        # image jobs and CLI commands: no request host, SERVER_NAME when it's set
+        if current_app.config.get('SERVER_NAME'):
+            return url_for('get_media', file_name=file_name, _external=True)
+        return '/media/' + file_name
+
+    def variantsJson(self):
+        data = {}
+        for name, variant in (self.variants or {}).items():
+            data[name] = {key: self.variantUrl(value) if key not in ('width', 'height') else value
+                          for key, value in variant.items()}
+        return data
+
+    def srcset(self):
+        """{format: 'url 200w, url 480w'} ready for <source srcset>"""
+        data = {}
+        for variant in sorted((self.variants or {}).values(), key=lambda variant: variant['width']):
+            for key, value in variant.items():
+                if key not in ('width', 'height'):
+                    data.setdefault(key, []).append(
+                        '{} {}w'.format(self.variantUrl(value), variant['width']))
+        return {key: ', '.join(value) for key, value in data.items()}
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     @classmethod
     def getByID(cls, media_id):
@@ -493,25 +1001,40 @@ class StructureMembre(db.Model):
     structure_id = Column(Integer, db.ForeignKey(
         'structures.id', ondelete="CASCADE"), primary_key=True)
     membre_id = Column(Integer, db.ForeignKey(
-        'membres.id', ondelete="CASCADE"), primary_key=True)
+        'membres.id', ondelete="CASCADE"), primary_key=True, index=True)
     actuel = Column(Boolean, nullable=False, default=True)
     date_affectation = Column(db.DateTime(timezone=True), nullable=False)
     fonction_id = Column(Integer, db.ForeignKey(
-        'fonctions.id'), nullable=False)
+        'fonctions.id'), nullable=False, index=True)
     structure = db.relationship(
         "Structure", back_populates="membres")
     membre = db.relationship("Membre", back_populates="structures")
 
+    # added to the json() of the structure
+    jsonSchema = Schema({'fonction': nested('fonction', Fonction.jsonSchema, 'fonction_id'), 'actuel': 'actuel',
+                         'date_affectation': iso('date_affectation')})
+
+    def json(self):
+        data = self.structure.json()
+        data.update(StructureMembre.jsonSchema(self))
+        return data
+
+    @staticmethod
+    def jsonOptions():
+        """loader options needed by json()"""
+        return [joinedload(StructureMembre.fonction),
+                joinedload(StructureMembre.structure).options(*Structure.jsonOptions())]
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<StructureMembre ID: {self.id} structure: {self.structure_id} membre: {self.membre_id} fonction: {self.fonction_id} >'
@@ -524,20 +1047,20 @@ class Programmation(db.Model):
     description = Column(Text, nullable=False)
     date_created = Column(db.DateTime(timezone=True),
                           server_default=func.now())
-    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     structure_id = Column(Integer, db.ForeignKey(
-        'structures.id'), nullable=False)
+        'structures.id'), nullable=False, index=True)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Programmation ID: {self.id} Title: {self.title} >'
@@ -551,20 +1074,20 @@ class Actualite(db.Model):
     status = Column(Boolean, nullable=False, default=False)
     date_created = Column(db.DateTime(timezone=True),
                           server_default=func.now())
-    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     structure_id = Column(Integer, db.ForeignKey(
-        'structures.id'), nullable=False)
+        'structures.id'), nullable=False, index=True)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Actualite ID: {self.id} Title: {self.title} >'
@@ -576,19 +1099,109 @@ class Statistique(db.Model):
     nombre_baptise = Column(Integer, nullable=False, default=0)
     annee_scolaire = Column(String(4), nullable=False)
     structure_id = Column(Integer, db.ForeignKey(
-        'structures.id'), nullable=False)
+        'structures.id'), nullable=False, index=True)
     nombre_consacre = Column(Integer, nullable=False, default=0)
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
     def __repr__(self):
         return f'<Statistique ID: {self.id} StructureID: {self.structure_id} >'
+
+
+'''
+CacheVersion
+a counter shared by every worker, bumped when the data behind a cache changes
+'''
+
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(db.DateTime(timezone=True),
+                        nullable=False, server_default=func.now())
+
+    """Increment counters, the change is committed with the session"""
+    @staticmethod
+    def bump(*names, connection=None):
+        stmt = insert(CacheVersion).values([{'name': name, 'version': 1} for name in sorted(names)]).on_conflict_do_update(
+            index_elements=[CacheVersion.name], set_={'version': CacheVersion.version + 1, 'updated_at': func.now()})
+        (connection or db.session).execute(stmt)
+
+    """Increment counters when the session commits, for the writes that don't go through a flush"""
+    @staticmethod
+    def bumpOnCommit(*names):
+        db.session.info.setdefault('written_tables', set()).update(names)
+
+    """Read the counters of several collections, returns (versions, last update)"""
+    @staticmethod
+    def snapshot(names):
+        rows = db.session.query(CacheVersion.name, CacheVersion.version, CacheVersion.updated_at).filter(
+            CacheVersion.name.in_(names)).all()
+        found = {row.name: row for row in rows}
+        versions = tuple(found[name].version if name in found else 0
+                         for name in names)
+        updated = [row.updated_at for row in rows]
+        return versions, max(updated) if updated else None
+
+    """Read a counter, bypassing the identity map so other workers' bumps are seen"""
+    @staticmethod
+    def current(name):
+        version = db.session.query(CacheVersion.version).filter(
+            CacheVersion.name == name).scalar()
+        return version or 0
+
+    def __repr__(self):
+        return f'<CacheVersion Name: {self.name} Version: {self.version} >'
+
+
+'''
+Collection versions
+    the tables each flush writes are collected and their CacheVersion rows are
+    bumped once, just before the commit, so flaskr.http_cache gets a cheap
+    token per collection whichever insert()/update()/delete() did the write.
+    The upsert locks the row of each table until the commit, bumping at every
+    flush would make the concurrent writers of a table wait for the whole
+    unit of work of each other
+'''
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_written_tables(session, flush_context, instances):
+    tables = session.info.setdefault('written_tables', set())
+    for instance in session.new:
+        tables.add(instance.__table__.name)
+    for instance in session.deleted:
+        tables.add(instance.__table__.name)
+    for instance in session.dirty:
+        if session.is_modified(instance):
+            tables.add(instance.__table__.name)
+
+
+# written on every login, no cached representation depends on them
+UNVERSIONED_TABLES = {'refresh_tokens'}
+
+
+@event.listens_for(Session, 'before_commit')
+def bump_written_tables(session):
+    if session.in_nested_transaction():
+        return
+    # the commit flushes the pending changes after this event
+    session.flush()
+    tables = session.info.pop('written_tables', set()) - UNVERSIONED_TABLES
+    if tables:
+        CacheVersion.bump(*tables, connection=session.connection())
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_written_tables(session):
+    session.info.pop('written_tables', None)
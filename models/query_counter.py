@@ -0,0 +1,51 @@
+"""SQL statement counting helpers"""
+from contextlib import contextmanager
+from sqlalchemy import event
+from .models import db
+
+
+class QueryCounter:
+    """Counts the statements sent to an engine while it is active
+
+        with QueryCounter() as counter:
+            client.get('/api/v1/structures')
+        print(counter.count, counter.statements)
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return False
+
+
+@contextmanager
+def assert_max_queries(limit, engine=None):
+    """Fails with an AssertionError if the block sends more than limit statements
+
+    Meant for tests guarding the eager loading of the list endpoints, the
+    count must not grow with the number of rows:
+
+        with assert_max_queries(4):
+            response = client.get('/api/v1/structures', headers=headers)
+    """
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError('{} queries executed, expected at most {}:\n{}'.format(
+            counter.count, limit, '\n'.join(counter.statements)))
@@ -0,0 +1,97 @@
+"""In-process cache of the administrative reference data
+
+Regions, departements, arrondissements, fonctions and typestructures change a
+few times a year, so every worker keeps them rendered in memory. The handlers
+that write them call reference_cache.invalidate(), which bumps the shared
+'reference' CacheVersion; the other gunicorn workers notice the new version
+at most REFERENCE_CACHE_CHECK_SECONDS later and reload. The conditional GETs
+(flaskr.http_cache) hand it the version their ETag was built from, so it
+reloads at once when it is behind and the body always matches the ETag.
+"""
+import os
+import threading
+import time
+from .models import Arrondissement, CacheVersion, Departement, Fonction, Region, TypeStructure, commit
+
+VERSION_NAME = 'reference'
+CHECK_SECONDS = float(os.environ.get('REFERENCE_CACHE_CHECK_SECONDS', 2))
+
+
+class ReferenceCache:
+    version_name = VERSION_NAME
+    models = {
+        'regions': Region,
+        'departements': Departement,
+        'arrondissements': Arrondissement,
+        'fonctions': Fonction,
+        'typestructures': TypeStructure,
+    }
+
+    def __init__(self, check_seconds=CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.version = None
+        self.checked_at = 0
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Renders every reference table, one query per table"""
+        data = {}
+        for name, model in self.models.items():
+            query = model.query
+            if hasattr(model, 'jsonOptions'):
+                query = query.options(*model.jsonOptions())
+            data[name] = {row.id: row.json() for row in query.all()}
+        return data
+
+    def behind(self, version):
+        return self.version is None or version > self.version
+
+    def refresh(self, version=None):
+        """Reloads the data if another worker (or this one) bumped the version
+
+        version is a counter just read, the data is then brought up to it
+        without waiting for the next check.
+        """
+        now = time.monotonic()
+        if version is not None:
+            if not self.behind(version):
+                return
+        elif self.version is not None and now - self.checked_at < self.check_seconds:
+            return
+        with self.lock:
+            if version is None:
+                version = CacheVersion.current(VERSION_NAME)
+                stale = version != self.version
+            else:
+                # another thread may have caught up while this one waited
+                stale = self.behind(version)
+            if stale:
+                # loaded after the counter was read, the data is at least that version
+                self.data = self.load()
+                self.version = version
+            self.checked_at = now
+
+    def get(self, name, _id):
+        """The json() of a row, or None if it doesn't exist. Do not mutate it"""
+        self.refresh()
+        try:
+            return self.data[name].get(int(_id))
+        except (TypeError, ValueError):
+            return None
+
+    def all(self, name):
+        self.refresh()
+        return list(self.data[name].values())
+
+    def exists(self, name, _id):
+        return self.get(name, _id) is not None
+
+    def invalidate(self):
+        """To be called after writing reference data, bumps the shared version when the transaction commits"""
+        CacheVersion.bumpOnCommit(VERSION_NAME)
+        commit()
+        self.version = None
+
+
+reference_cache = ReferenceCache()
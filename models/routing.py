@@ -0,0 +1,109 @@
+"""Read Replica Routing
+
+With DATABASE_REPLICA_URLS set, db.session sends the reads of GET and HEAD
+requests to one of the replicas, picked once per request so the CacheVersion
+counters of the ETags and the data come from the same server. Everything
+else stays on the primary: other methods, flushes and Core writes, and any
+read that follows a write in the same request.
+
+A replica is skipped while its replication lag is above DB_REPLICA_MAX_LAG
+seconds or it can't be reached; the lag is measured at most every
+DB_REPLICA_CHECK_SECONDS per worker, by one request at a time while the
+others keep the last measure, on a connection of its own that gives up
+after DB_REPLICA_PROBE_TIMEOUT seconds (2, libpq's minimum).
+"""
+import logging
+import os
+import random
+import threading
+import time
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+REPLICA_PREFIX = 'replica_'
+READ_METHODS = ('GET', 'HEAD')
+MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+CHECK_SECONDS = float(os.environ.get('DB_REPLICA_CHECK_SECONDS', 5))
+PROBE_TIMEOUT = int(os.environ.get('DB_REPLICA_PROBE_TIMEOUT', 2))
+LAG_QUERY = text("""SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END""")
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaMonitor:
+    def __init__(self, max_lag=MAX_LAG, check_seconds=CHECK_SECONDS):
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        # bind key: (lag in seconds or None when unreachable, checked at)
+        self.lags = {}
+        # bind key: engine of the lag probes, outside of the pool and with short timeouts
+        self.probes = {}
+
+    def probe(self, key, engine):
+        if key not in self.probes:
+            self.probes[key] = create_engine(engine.url, poolclass=NullPool, connect_args={
+                'connect_timeout': PROBE_TIMEOUT,
+                'options': '-c statement_timeout={}'.format(PROBE_TIMEOUT * 1000)})
+        return self.probes[key]
+
+    def measure(self, key, engine):
+        try:
+            with self.probe(key, engine).connect() as connection:
+                return float(connection.execute(LAG_QUERY).scalar())
+        except Exception:
+            logger.warning('replica %s unreachable', engine.url, exc_info=True)
+            return None
+
+    def stale(self, key):
+        checked_at = self.lags.get(key, (None, None))[1]
+        return checked_at is None or time.monotonic() - checked_at >= self.check_seconds
+
+    def lag(self, key, engine):
+        # one request measures, the others go on with the last lag instead of
+        # waiting for it, None (the primary) before the first measure
+        if self.stale(key) and self.lock.acquire(blocking=False):
+            try:
+                if self.stale(key):
+                    self.lags[key] = (self.measure(key, engine), time.monotonic())
+            finally:
+                self.lock.release()
+        return self.lags.get(key, (None, None))[0]
+
+    def choose(self, engines):
+        """A replica engine close enough to the primary, or None"""
+        healthy = []
+        for key, engine in engines.items():
+            if key and key.startswith(REPLICA_PREFIX):
+                lag = self.lag(key, engine)
+                if lag is not None and lag <= self.max_lag:
+                    healthy.append(engine)
+        return random.choice(healthy) if healthy else None
+
+    def json(self):
+        return {key: lag for key, (lag, checked_at) in self.lags.items()}
+
+
+replica_monitor = ReplicaMonitor()
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.reads_from_replica(clause):
+            if 'replica' not in self.info:
+                self.info['replica'] = replica_monitor.choose(self._db.engines)
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+    def reads_from_replica(self, clause):
+        # autoflush runs before a query picks its bind, so a pending change
+        # is flushed, and noticed here, before the read that follows it
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = True
+        if self.info.get('wrote'):
+            return False
+        return has_request_context() and request.method in READ_METHODS
@@ -0,0 +1,152 @@
+"""Serializer Schemas
+
+A Schema describes the dict of a model once, {key: field}, and is compiled
+into a tuple of (key, getter) so serializing a row is a single loop of plain
+function calls, without the attribute lookups and branches of a hand written
+json() method. A field is:
+
+    'attribute'             the attribute, dotted names follow relationships
+    iso('attribute')        a date or datetime as an ISO 8601 string
+    nested('relationship', schema, 'foreign_key')
+                            the schema (or the name of a method) of a related
+                            row, None when the foreign key is
+    many('relationship', schema)
+                            the list of the related rows
+    method('name', columns) the result of a method of the row
+    a callable              called with the row
+
+Schema.sparse() narrows a schema to some keys and collapses the relationships
+that aren't expanded, to their foreign key for nested() and out for many().
+columns() and relations() tell what the narrowed schema reads, for load_only
+and the loader options; serializer() what a relationship is dumped with, the
+method <name> of a related row needs the loader options of <name>Options().
+"""
+from datetime import date
+from operator import attrgetter, methodcaller
+
+
+def iso(name):
+    get = attrgetter(name)
+
+    def getter(row):
+        value = get(row)
+        return value.isoformat() if isinstance(value, date) else value
+    getter.columns = (name,)
+    return getter
+
+
+def dumper(schema):
+    return schema if isinstance(schema, Schema) else methodcaller(schema)
+
+
+def nested(name, schema, foreign_key):
+    get = attrgetter(name)
+    get_key = attrgetter(foreign_key)
+    dump = dumper(schema)
+
+    def getter(row):
+        # a missing foreign key spares the lazy load of the relationship
+        if get_key(row) is None:
+            return None
+        value = get(row)
+        return dump(value) if value is not None else None
+    getter.columns = (foreign_key,)
+    getter.relation = name
+    getter.foreign_key = foreign_key
+    getter.serializer = schema
+    return getter
+
+
+def many(name, schema):
+    get = attrgetter(name)
+    dump = dumper(schema)
+
+    def getter(row):
+        return [dump(value) for value in get(row)]
+    getter.columns = ()
+    getter.relation = name
+    getter.foreign_key = None
+    getter.serializer = schema
+    return getter
+
+
+def method(name, columns=()):
+    call = methodcaller(name)
+
+    def getter(row):
+        return call(row)
+    getter.columns = tuple(columns)
+    return getter
+
+
+class Schema:
+    def __init__(self, fields):
+        self.fields = tuple((key, attrgetter(field) if isinstance(field, str) else field)
+                            for key, field in fields.items())
+        # key: (columns read, relationship or None, foreign key or None)
+        self.meta = {key: ((field,), None, None) if isinstance(field, str) else
+                     (getattr(field, 'columns', ()), getattr(field, 'relation', None),
+                      getattr(field, 'foreign_key', None))
+                     for key, field in fields.items()}
+
+    def extend(self, fields):
+        """A new schema with more fields after these ones"""
+        schema = Schema(fields)
+        schema.fields = self.fields + schema.fields
+        schema.meta = dict(self.meta, **schema.meta)
+        return schema
+
+    def keys(self):
+        return [key for key, get in self.fields]
+
+    def sparse(self, fields=None, expand=None):
+        """The schema of the keys in fields, the relationships not in expand
+        collapsed; None for either keeps them all"""
+        schema = Schema({})
+        selected = []
+        for key, get in self.fields:
+            columns, relation, foreign_key = self.meta[key]
+            if fields is not None and key not in fields:
+                continue
+            if relation is not None and expand is not None and key not in expand:
+                if foreign_key is None:
+                    continue
+                get = attrgetter(foreign_key)
+                columns, relation = (foreign_key,), None
+            selected.append((key, get))
+            schema.meta[key] = (columns, relation, foreign_key)
+        schema.fields = tuple(selected)
+        return schema
+
+    def columns(self):
+        """The attributes the schema reads from the row itself"""
+        return {column for columns, relation, foreign_key in self.meta.values() for column in columns}
+
+    def relations(self):
+        """{key: relationship} of the expanded relationships"""
+        return {key: relation for key, (columns, relation, foreign_key) in self.meta.items()
+                if relation is not None}
+
+    def serializer(self, key):
+        """The schema or the name of the method a relationship is dumped with"""
+        return getattr(dict(self.fields)[key], 'serializer', None)
+
+    def project(self, data, fields=None, expand=None):
+        """sparse() applied to a dict already built with this schema"""
+        projected = {}
+        for key, value in data.items():
+            if fields is not None and key not in fields:
+                continue
+            columns, relation, foreign_key = self.meta.get(key, ((), None, None))
+            if relation is not None and expand is not None and key not in expand:
+                if foreign_key is None:
+                    continue
+                value = value['id'] if value is not None else None
+            projected[key] = value
+        return projected
+
+    def __call__(self, row):
+        return {key: get(row) for key, get in self.fields}
+
+    def many(self, rows):
+        return [self(row) for row in rows]
@@ -0,0 +1,56 @@
+"""Keyset pagination of the list endpoints"""
+from models.models import Structure, db
+
+
+def walk(client, headers, url):
+    """The rows of every page of url, following next_cursor"""
+    rows, cursor, pages = [], None, 0
+    while True:
+        response = client.get(url + ('&cursor=' + cursor if cursor else ''), headers=headers)
+        assert response.status_code == 200
+        body = response.get_json()
+        rows.extend(body['data'])
+        pages += 1
+        cursor = body['meta']['next_cursor']
+        if cursor is None:
+            return rows, pages
+
+
+def test_cursors_walk_every_row_once(app, client, headers, data):
+    rows, pages = walk(client, headers, '/api/v1/structures?limit=4')
+    ids = [row['id'] for row in rows]
+    assert ids == sorted([data.synode] + data.presbyteres + data.paroisses)
+    assert pages == 5
+
+
+def test_cursors_follow_a_descending_sort_on_name(client, headers, data):
+    rows, pages = walk(client, headers, '/api/v1/structures?limit=3&sort=-name')
+    names = [row['name'] for row in rows]
+    assert names == sorted(names, reverse=True)
+    assert len(names) == len(set(names)) == 19
+
+
+def test_cursors_keep_the_filters(client, headers, data):
+    rows, pages = walk(client, headers, '/api/v1/structures?limit=2&parent={}'.format(data.presbyteres[1]))
+    assert [row['id'] for row in rows] == data.paroisses[5:10]
+
+
+def test_a_cursor_is_not_shifted_by_a_deleted_row(app, client, headers, data):
+    first = client.get('/api/v1/structures?limit=5', headers=headers).get_json()
+    with app.app_context():
+        db.session.delete(Structure.getByID(first['data'][-1]['id']))
+        db.session.commit()
+    second = client.get('/api/v1/structures?limit=5&cursor=' + first['meta']['next_cursor'], headers=headers)
+    assert second.get_json()['data'][0]['id'] == first['data'][-1]['id'] + 1
+
+
+def test_meta(client, headers, data):
+    meta = client.get('/api/v1/structures?limit=50', headers=headers).get_json()['meta']
+    assert meta == {'limit': 50, 'sort': 'id', 'total': 19, 'next_cursor': None}
+    meta = client.get('/api/v1/structures?limit=5&count=false', headers=headers).get_json()['meta']
+    assert 'total' not in meta and meta['next_cursor']
+
+
+def test_invalid_arguments(client, headers, data):
+    for query in ('cursor=not-a-cursor', 'cursor=WzFd', 'sort=bogus', 'limit=0', 'parent=x'):
+        assert client.get('/api/v1/structures?' + query, headers=headers).status_code == 400, query
@@ -0,0 +1,63 @@
+"""The list and detail endpoints send a fixed number of statements, whatever
+the number of rows and relationships they return"""
+from datetime import datetime
+import pytest
+from models.models import Structure, StructureMembre, db
+from models.query_counter import QueryCounter, assert_max_queries
+
+# the conditional GET reads the cache versions, the lists count their rows
+ENDPOINTS = [
+    ('/api/v1/regions', 3),
+    ('/api/v1/departements', 3),
+    ('/api/v1/arrondissements', 3),
+    ('/api/v1/fonctions', 3),
+    ('/api/v1/typestructures', 3),
+    ('/api/v1/structures', 4),
+    ('/api/v1/membres', 6),
+    ('/api/v1/structures/{presbytere}', 6),
+    ('/api/v1/structures/{paroisse}?expand=parent', 6),
+    ('/api/v1/structures/{synode}/descendants', 5),
+    ('/api/v1/structures/{paroisse}/ancestors', 4),
+    ('/api/v1/membres/{membre}', 5),
+    ('/api/v1/typestructures/{type}', 1),
+]
+
+
+def url_of(template, data):
+    return template.format(presbytere=data.presbyteres[0], paroisse=data.paroisses[0], synode=data.synode,
+                           membre=data.membres[0], type=data.types[2])
+
+
+def statements(app, client, headers, url):
+    with app.app_context(), QueryCounter() as counter:
+        assert client.get(url, headers=headers).status_code == 200
+    return counter.count
+
+
+@pytest.mark.parametrize('template, limit', ENDPOINTS)
+def test_statements(app, client, headers, data, template, limit):
+    url = url_of(template, data)
+    # the first request loads the reference cache
+    client.get(url, headers=headers)
+    with app.app_context(), assert_max_queries(limit):
+        response = client.get(url, headers=headers)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('template', ['/api/v1/structures', '/api/v1/membres',
+                                      '/api/v1/structures/{presbytere}', '/api/v1/structures/{synode}/descendants'])
+def test_statements_dont_grow_with_the_rows(app, client, headers, data, template):
+    url = url_of(template, data)
+    client.get(url, headers=headers)
+    before = statements(app, client, headers, url)
+    with app.app_context():
+        for i in range(10):
+            structure = Structure(sturcture_name='Nouvelle paroisse {}'.format(i), structure_contacts='1',
+                                  typestructure_id=data.types[2], arrondissement_id=data.arrondissements[i],
+                                  parent_id=data.presbyteres[0])
+            db.session.add(structure)
+            db.session.flush()
+            db.session.add(StructureMembre(structure_id=structure.id, membre_id=data.membres[i % 5],
+                                           fonction_id=data.fonction, date_affectation=datetime(2021, 1, 1)))
+        db.session.commit()
+    assert statements(app, client, headers, url) == before
@@ -0,0 +1,74 @@
+"""Refresh token rotation and reuse detection"""
+from datetime import datetime, timedelta
+from models.models import RefreshToken, db
+from .conftest import PASSWORD
+
+
+def login(client, data):
+    response = client.post('/api/v1/login', json={'email': data.email, 'password': PASSWORD})
+    assert response.status_code == 200
+    return response.get_json()['data']['refresh_token']
+
+
+def refresh(client, token):
+    return client.post('/api/v1/token/refresh', json={'refresh_token': token})
+
+
+def reasons(app, data):
+    with app.app_context():
+        return sorted((token.revoked_reason or '') for token in RefreshToken.query.filter_by(user_id=data.user))
+
+
+def test_refresh_rotates_the_token(app, client, data):
+    token = login(client, data)
+    response = refresh(client, token)
+    assert response.status_code == 200
+    tokens = response.get_json()['data']
+    assert tokens['token'] and tokens['refresh_token'] != token
+    assert refresh(client, tokens['refresh_token']).status_code == 200
+
+
+def test_reusing_a_rotated_token_revokes_all_the_tokens_of_the_user(app, client, data):
+    token = login(client, data)
+    other_session = login(client, data)
+    rotated = refresh(client, token).get_json()['data']['refresh_token']
+
+    assert refresh(client, token).status_code == 401
+    assert refresh(client, rotated).status_code == 401
+    assert refresh(client, other_session).status_code == 401
+    assert reasons(app, data) == ['REUSE', 'REUSE', 'ROTATED']
+
+
+def test_replaying_a_logged_out_token_keeps_the_other_sessions(app, client, data):
+    token = login(client, data)
+    other_session = login(client, data)
+    assert client.post('/api/v1/logout', json={'refresh_token': token}).status_code == 200
+
+    assert refresh(client, token).status_code == 401
+    assert refresh(client, other_session).status_code == 200
+    assert reasons(app, data) == ['', 'LOGOUT', 'ROTATED']
+
+
+def test_expired_token(app, client, data):
+    token = login(client, data)
+    with app.app_context():
+        RefreshToken.getByToken(token).expires_at = datetime.utcnow() - timedelta(minutes=1)
+        db.session.commit()
+    response = refresh(client, token)
+    assert response.status_code == 401
+    assert response.get_json()['message'] == 'Refresh token expired'
+
+
+def test_unknown_token(client, data):
+    assert refresh(client, 'not-a-token').status_code == 401
+
+
+def test_only_one_claim_of_a_token_succeeds(app, data):
+    with app.app_context():
+        token = RefreshToken.getByToken(RefreshToken.issue(data.user))
+        db.session.commit()
+        assert token.claim()
+        assert not token.claim()
+        assert not token.revoke('LOGOUT')
+        db.session.commit()
+        assert token.wasRotated()
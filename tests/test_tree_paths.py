@@ -0,0 +1,105 @@
+"""Materialized paths of the structure tree"""
+import pytest
+from sqlalchemy import text
+from models.models import Structure, db
+
+
+def path(_id):
+    return Structure.getByID(_id).path
+
+
+def subtree(_id):
+    return sorted(structure.id for structure in Structure.getByID(_id).descendants())
+
+
+def test_paths_are_set_on_insert(app, data):
+    with app.app_context():
+        assert path(data.synode) == '/{}/'.format(data.synode)
+        assert path(data.presbyteres[0]) == '/{}/{}/'.format(data.synode, data.presbyteres[0])
+        assert path(data.paroisses[0]) == '/{}/{}/{}/'.format(data.synode, data.presbyteres[0], data.paroisses[0])
+        assert subtree(data.presbyteres[0]) == data.paroisses[:5]
+        assert [ancestor.id for ancestor in Structure.getByID(data.paroisses[0]).ancestors()] == [
+            data.synode, data.presbyteres[0]]
+
+
+def test_moving_a_structure_moves_its_subtree(app, data):
+    with app.app_context():
+        moved = Structure.getByID(data.presbyteres[0])
+        moved.parent_id = data.presbyteres[1]
+        db.session.commit()
+        new_path = path(data.presbyteres[1]) + '{}/'.format(data.presbyteres[0])
+        assert path(data.presbyteres[0]) == new_path
+        assert path(data.paroisses[0]) == new_path + '{}/'.format(data.paroisses[0])
+        assert subtree(data.presbyteres[1]) == sorted(data.paroisses[:10] + [data.presbyteres[0]])
+        assert subtree(data.presbyteres[0]) == data.paroisses[:5]
+
+
+def test_moving_to_the_root(app, data):
+    with app.app_context():
+        Structure.getByID(data.presbyteres[2]).parent_id = None
+        db.session.commit()
+        assert path(data.paroisses[10]) == '/{}/{}/'.format(data.presbyteres[2], data.paroisses[10])
+        assert subtree(data.synode) == sorted(data.presbyteres[:2] + data.paroisses[:10])
+
+
+@pytest.mark.parametrize('parent', ['self', 'child', 'grandchild'])
+def test_a_structure_cannot_be_moved_under_its_own_subtree(app, data, parent):
+    parent_id = {'self': data.synode, 'child': data.presbyteres[0], 'grandchild': data.paroisses[0]}[parent]
+    with app.app_context():
+        Structure.getByID(data.synode).parent_id = parent_id
+        with pytest.raises(ValueError):
+            db.session.flush()
+        db.session.rollback()
+        assert Structure.getByID(data.synode).parent_id is None
+        assert path(data.paroisses[0]) == '/{}/{}/{}/'.format(data.synode, data.presbyteres[0], data.paroisses[0])
+
+
+def test_the_api_rejects_a_cycle(app, client, headers, data):
+    response = client.put('/api/v1/structures/{}'.format(data.presbyteres[0]), headers=headers, json={
+        'name': 'Presbytere 0', 'adresse': 'a', 'contacts': '1', 'type': data.types[1],
+        'arrondissement': data.arrondissements[0], 'parent': data.paroisses[0]})
+    assert response.status_code >= 400
+    with app.app_context():
+        assert Structure.getByID(data.presbyteres[0]).parent_id == data.synode
+        assert subtree(data.presbyteres[0]) == data.paroisses[:5]
+
+
+def test_rows_without_a_path_use_the_parent_chain(app, data):
+    with app.app_context():
+        db.session.execute(text('UPDATE structures SET path = NULL'))
+        db.session.commit()
+        assert subtree(data.synode) == sorted(data.presbyteres + data.paroisses)
+        structure = Structure(sturcture_name='Paroisse sans chemin', structure_contacts='1',
+                              typestructure_id=data.types[2], arrondissement_id=data.arrondissements[0],
+                              parent_id=data.presbyteres[0])
+        structure.insert()
+        assert structure.path == '/{}/{}/{}/'.format(data.synode, data.presbyteres[0], structure.id)
+
+
+def test_a_parent_without_a_root_is_rejected(app, data):
+    with app.app_context():
+        db.session.execute(text('UPDATE structures SET path = NULL'))
+        db.session.execute(text('UPDATE structures SET parent_id = :child WHERE id = :synode'),
+                           {'child': data.presbyteres[0], 'synode': data.synode})
+        db.session.commit()
+        structure = Structure(sturcture_name='Paroisse orpheline', structure_contacts='1',
+                              typestructure_id=data.types[2], arrondissement_id=data.arrondissements[0],
+                              parent_id=data.presbyteres[0])
+        db.session.add(structure)
+        with pytest.raises(ValueError):
+            db.session.flush()
+
+
+def test_the_import_builds_the_missing_parent_paths(app, client, headers, data):
+    with app.app_context():
+        db.session.execute(text('UPDATE structures SET path = NULL WHERE id IN (:synode, :presbytere)'),
+                           {'synode': data.synode, 'presbytere': data.presbyteres[0]})
+        db.session.commit()
+    response = client.post('/api/v1/structures/import', headers=headers, json=[
+        {'name': 'Paroisse importee', 'adresse': 'a', 'contacts': '1', 'type': data.types[2],
+         'arrondissement': data.arrondissements[0], 'parent': data.presbyteres[0]}])
+    assert response.status_code == 201
+    with app.app_context():
+        imported = Structure.getByName('Paroisse importee')
+        assert imported.path == '/{}/{}/{}/'.format(data.synode, data.presbyteres[0], imported.id)
+        assert imported.id in subtree(data.presbyteres[0])
@@ -0,0 +1,101 @@
+"""The unit of work commits once and runs the after commit callbacks"""
+import logging
+import pytest
+from flaskr.transaction import transactional
+from models.models import Region, after_commit, commit, db, unit_of_work
+
+
+def committed_regions():
+    """The region names another connection sees"""
+    with db.engine.connect() as connection:
+        return set(connection.scalars(db.select(Region.region_name)))
+
+
+def test_commits_once_at_the_end(app):
+    with app.app_context():
+        with unit_of_work():
+            Region(region_name='Littoral').insert()
+            with unit_of_work():
+                Region(region_name='Centre').insert()
+            assert committed_regions() == set()
+        assert committed_regions() == {'Littoral', 'Centre'}
+
+
+def test_rolls_back_everything_on_error(app):
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                Region(region_name='Littoral').insert()
+                with unit_of_work():
+                    Region(region_name='Centre').insert()
+                raise RuntimeError()
+        assert committed_regions() == set()
+        # the session is usable again
+        Region(region_name='Ouest').insert()
+        assert committed_regions() == {'Ouest'}
+
+
+def test_callbacks_run_after_the_commit(app):
+    seen = []
+    with app.app_context():
+        with unit_of_work():
+            Region(region_name='Littoral').insert()
+            after_commit(lambda: seen.append(committed_regions()))
+            assert seen == []
+        assert seen == [{'Littoral'}]
+
+
+def test_callbacks_are_dropped_on_rollback(app):
+    seen = []
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                after_commit(lambda: seen.append('called'))
+                raise RuntimeError()
+        with unit_of_work():
+            pass
+    assert seen == []
+
+
+def test_a_failing_callback_is_logged_and_the_others_run(app, caplog):
+    seen = []
+    with app.app_context():
+        with caplog.at_level(logging.ERROR, logger='models.models'):
+            with unit_of_work():
+                Region(region_name='Littoral').insert()
+                after_commit(lambda: 1 / 0)
+                after_commit(lambda: seen.append('called'))
+        assert committed_regions() == {'Littoral'}
+    assert seen == ['called']
+    assert 'after commit callback' in caplog.text and 'ZeroDivisionError' in caplog.text
+
+
+def test_callbacks_outside_of_a_unit_of_work_run_at_once(app):
+    seen = []
+    with app.app_context():
+        after_commit(lambda: seen.append('called'))
+    assert seen == ['called']
+
+
+def test_commit_only_flushes_inside_a_unit_of_work(app):
+    with app.app_context():
+        with unit_of_work():
+            region = Region(region_name='Littoral')
+            db.session.add(region)
+            commit()
+            assert region.id is not None
+            assert committed_regions() == set()
+        assert committed_regions() == {'Littoral'}
+
+
+def test_a_handler_answering_an_error_is_rolled_back(app):
+    @transactional
+    def handler(status):
+        Region(region_name='Littoral').insert()
+        return {'success': status < 400}, status
+
+    with app.test_request_context():
+        assert handler(409).status_code == 409
+        assert committed_regions() == set()
+        assert handler(201).status_code == 201
+        assert committed_regions() == {'Littoral'}